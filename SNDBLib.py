@@ -7,20 +7,69 @@
 ###########################################################
 
 import re
+import sys
+import fnmatch
+import time
+import Queue
+import threading
+import sqlite3
 from glob import glob
-from os import walk, path, system
+from os import walk, path, system, listdir, stat
 import numpy as np
 import matplotlib.pyplot as plt
 import pyfits as pf
 from difflib import get_close_matches
-from cStringIO import StringIO
+import gzip
+import zlib
 from subprocess import Popen,PIPE
+from multiprocessing import Pool, TimeoutError
+from multiprocessing.pool import ThreadPool
 from dateutil import parser
-from urllib2 import urlopen
 from bs4 import BeautifulSoup
-# import julian_dates as jd
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
+import codecs
+import file_catalog
+import header_cache
+import rochester_cache
+import http_cache
+import spectrum_store
+import snid_cache
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+import julian_dates as jd
+
+SPEC_DATE_RX = re.compile('\d{8}(\.\d+)?')
+SPEC_COLOR_TAGS = set(['blue','red'])
+# version of what get_info_*_fitsfile return; bump it whenever their parsing changes,
+#  so that the header cache stops handing back dictionaries made by the old code
+HEADER_INFO_VERSION = 2
+FITS_BLOCK = 2880
+# HTML elements that never have an end tag
+VOID_TAGS = set(['area','base','br','col','embed','hr','img','input','keygen','link','meta','param','source','track','wbr'])
+ROCHESTER_DICT = None
+_ROCHESTER_LOCK = threading.Lock()
+_ROCHESTER_INDEX = None  # (dict it was built from, names, SkyIndex)
+# where the resolvers send their queries (can be pointed at a local stand-in for testing)
+SIMBAD_URI = "http://simbad.u-strasbg.fr/simbad/sim-id?output.format=ASCII&Ident=%s"
+TNS_URI = 'https://wis-tns.weizmann.ac.il'
+ROCHESTER_URI = 'http://www.rochesterastronomy.org/snimages/'
+# SIMBAD's answer when it doesn't know the identifier
+SIMBAD_NOT_FOUND = re.compile('[Ii]dentifier not found')
+# a TNS csv search with nothing but the header line
+TNS_NO_RESULTS = re.compile('\A[^\n]*\n?\Z')
+# how long (s) resolve_object waits on each source; Rochester may have to download its pages first
+RESOLVER_TIMEOUTS = {'tns':60., 'rochester':300., 'simbad':60.}
+# the SNID executable getSNID runs (fake_snid.py can stand in for it)
+SNID_CMD = 'snid'
+IMAGE_RX = re.compile('\.((fit)|(fits)|(fts))($|\.[zZ]$)')
 
-def yield_all_spectra( location='/media/raid0/Data/spectra/', include_details_flm=False, require_fits=False ):
+def yield_all_spectra( location='/media/raid0/Data/spectra/', include_details_flm=False, require_fits=False, use_catalog=True, ambiguous=None ):
     """
     Searches <location> (and subfolders) for all spectra.
     Finds all files named like *.flm and attempts to associate each with 
@@ -29,76 +78,531 @@ def yield_all_spectra( location='/media/raid0/Data/spectra/', include_details_fl
 
     If include_details_flm == True, will include *.flm files found in a '/details/' subfolder.
     If require_fits == True, will only yeild *.flm files with a good match for a fitsfile too.
+    If use_catalog == True (default), the directory listings come from the on-disk
+     file catalog (see file_catalog.py), which only re-lists folders that changed
+     since the last scan.  Set to False to walk the disk directly (as is done anyway
+     if the catalog cannot be used).
+    If a list is passed as <ambiguous>, a tuple of (flm, chosen_fits, [equally good fits])
+     is appended to it for every spectrum whose fits pairing was ambiguous.
     
     Example: 
      > s = yield_all_spectra()
      > path_to_spec_1, path_to_fitsfile_1 = s.next()
      > path_to_spec_2, path_to_fitsfile_2 = s.next()
     """
-    for root,subdirs,fnames in walk(location):
+    catalog = file_catalog.get_catalog() if use_catalog else None
+    if catalog != None:
+        try:
+            catalog.rescan( location )
+            listings = catalog.snapshot( location )
+        except sqlite3.Error, e:
+            print 'Cannot use the file catalog (%s); walking %s instead.' %(e, location)
+            catalog = None
+    if catalog != None:
+        tree = catalog.walk( location, snapshot=listings )
+        # symlinked folders are not descended into by the catalog, so those are listed from the disk
+        list_fits = lambda d: fnmatch.filter( listings[d][1], '*.fits' ) if d in listings else map(path.basename, glob(d+'/*.fits'))
+    else:
+        tree = walk( location )
+        list_fits = lambda d: map(path.basename, glob(d+'/*.fits'))
+    for root,subdirs,fnames in tree:
+        flms = []
         for f in fnames:
             if re.search('.+\.flm',f):
                 # we found a spectrum
-                flm = root + '/'+f
-                matching_fits = None
-                # first look for a local matching fits file
-                local_fs = map(path.basename, glob(root+'/*.fits'))
-                # if there's a pretty good match, just use it
-                bestmatch = get_close_matches(f, local_fs, n=1)
-                if bestmatch:
-                    matching_fits = '%s/%s' %(root,bestmatch[0])
-                else:
-                    # if there's not, then look in all subfolders one layer deep
-                    if subdirs:
-                        for sd in subdirs:
-                            sub_fs = map(path.basename, glob(root+'/'+sd+'/*.fits'))
-                            bestmatch = get_close_matches(f, sub_fs, n=1)
-                            if bestmatch:
-                                matching_fits = '%s/%s/%s' %(root,sd,bestmatch[0])
-                                break
-                # record the best matching fits file, or None if no good match found
                 if not include_details_flm:
                     # do not return this pair if the flm file is in a details subfolder
-                    if re.search('details', flm):
+                    if re.search('details', root + '/'+f):
                         continue
-                if require_fits and (matching_fits == None):
-                    continue
-                yield flm, matching_fits
+                flms.append( f )
+        if not flms:
+            continue
+        # list this folder and all subfolders one layer deep only once, and pair everything at once
+        fits_listings = [ ('', list_fits(root)) ] + [ (sd, list_fits(root+'/'+sd)) for sd in subdirs ]
+        pairs, ambiguities = pair_spectra( flms, fits_listings )
+        for f in flms:
+            flm = root + '/'+f
+            # record the best matching fits file, or None if no good match found
+            matching_fits = None
+            if pairs[f] != None:
+                matching_fits = '%s/%s' %(root,pairs[f])
+            if require_fits and (matching_fits == None):
+                continue
+            if (ambiguous != None) and (f in ambiguities):
+                ambiguous.append( (flm, matching_fits, ['%s/%s' %(root,c) for c in ambiguities[f]]) )
+            yield flm, matching_fits
+
+def tokenize_spectrum_filename( f ):
+    """
+    Splits a spectrum filename (*.flm or *.fits) into the object name, the
+     date string, and the set of other tags (e.g. blue, red, blotch).
+    Returns (object, datestring, tags); object and datestring are None if
+     there is no 8-digit date in the name.
+
+    Example:
+     > tokenize_spectrum_filename( 'SN2016abc-20160315.345-blue.fits' )
+     ('sn2016abc', '20160315.345', set(['blue']))
+    """
+    stem = path.basename( f ).lower()
+    for ext in ['.flm', '.fits']:
+        if stem.endswith( ext ):
+            stem = stem[:-len(ext)]
+    m = SPEC_DATE_RX.search( stem )
+    if m == None:
+        return None, None, set( re.split('[-_.]+', stem) ) - set([''])
+    obj = stem[:m.start()].strip('-_.')
+    tags = set( re.split('[-_.]+', stem[m.end():]) ) - set([''])
+    return obj, m.group(), tags
+
+def pair_spectra( flms, fits_listings ):
+    """
+    Pairs each *.flm filename in <flms> with a fits file.
+    <fits_listings> is an ordered list of (subfolder, [fits filenames]) to search,
+     with subfolder '' for the folder holding the flm files.
+
+    Each folder is searched in turn, and the first one with a match wins, so a local
+     fits file is always taken before any in a subfolder, as yield_all_spectra always
+     has.  Within a folder, filenames are split by tokenize_spectrum_filename and
+     matched on (object, day) through a hash index; when several fits files share that
+     key, the one with the same full date string and the same blue/red tags wins.
+     Only if the index has no candidate in that folder is the (slow) difflib fuzzy
+     matching tried there.
+
+    Returns (pairs, ambiguous):
+     pairs: {flm: path to fits relative to the flm folder, or None}
+     ambiguous: {flm: [equally good candidates]} for pairs that were a coin toss.
+    """
+    indices = []
+    for sd, names in fits_listings:
+        index = {}
+        for n in names:
+            obj, date, tags = tokenize_spectrum_filename( n )
+            if date != None:
+                index.setdefault( (obj, date[:8]), [] ).append( (n, date, tags) )
+        indices.append( (sd, names, index) )
+    relpath = lambda sd, n: sd+'/'+n if sd else n
+
+    pairs, ambiguous = {}, {}
+    for f in flms:
+        pairs[f] = None
+        obj, date, tags = tokenize_spectrum_filename( f )
+        tags = tags - set(['blotch'])  # fits files are never blotched
+        for sd, names, index in indices:
+            candidates = index.get( (obj, date[:8]) ) if date != None else None
+            if candidates:
+                scored = [ ((cdate == date, ctags == tags, ctags & SPEC_COLOR_TAGS == tags & SPEC_COLOR_TAGS), n)
+                           for n, cdate, ctags in candidates ]
+                best = max( [score for score,n in scored] )
+                top = [n for score,n in scored if score == best]
+                if len(top) == 1:
+                    pairs[f] = relpath( sd, top[0] )
+                else:
+                    pairs[f] = relpath( sd, get_close_matches(f, top, n=1, cutoff=0.)[0] )
+                    ambiguous[f] = [relpath( sd, n ) for n in top]
+                break
+            bestmatch = get_close_matches(f, names, n=1)
+            if bestmatch:
+                pairs[f] = relpath( sd, bestmatch[0] )
+                break
+    return pairs, ambiguous
  
-def yield_all_images( location='/media/raid0/Data/nickel/follow/' ):
+def yield_all_images( location='/media/raid0/Data/nickel/follow/', nthreads=1, ordered=False, report=False ):
     """
     Searches <location> (and subfolders) for all images.
     Finds all files named like *.fit, *.fit.Z, *.fits, *.fits.Z, *.fts, *.fts.Z
     and yields them one at a time (this is an iterator).
 
+    If nthreads > 1, the tree is listed by that many threads at once (see walk_directories),
+     and images come out in whatever order the folders are listed in, unless
+     ordered == True, in which case the walk is finished first and the images are
+     yielded in the same order as a single-threaded walk.
+    If report == True, prints the number of folders/files scanned and the throughput
+     once the walk is done.
+
     Example:
      > i = yield_all_images()
      > path_to_image_1 = i.next()
      > path_to_image_2 = i.next()
      > ...
     """
-    rx = '\.((fit)|(fits)|(fts))($|\.[zZ]$)'
-    for root,subdirs,fnames in walk(location):
+    t0 = time.time()
+    ndirs, nfiles, nimages = 0, 0, 0
+    tree = walk_directories( location, nthreads=nthreads )
+    if ordered and (nthreads > 1):
+        # gather the whole tree and replay it in single-threaded order
+        listings = dict( [(d, (subdirs, fnames)) for d,subdirs,fnames in tree] )
+        def replay( top ):
+            stack = [top]
+            while stack:
+                d = stack.pop()
+                subdirs, fnames = listings.get( d, ([], []) )
+                yield d, subdirs, fnames
+                stack.extend( [path.join(d, sd) for sd in reversed(subdirs)] )
+        tree = replay( location.rstrip('/') or '/' )
+    for root,subdirs,fnames in tree:
+        ndirs += 1
+        nfiles += len(fnames)
         for f in fnames:
-            if re.search(rx, f):
+            if IMAGE_RX.search( f ):
+                nimages += 1
                 yield '%s/%s' %(root,f)
+    if report:
+        dt = time.time() - t0
+        print 'Scanned %d folders and %d files in %.1f s (%.0f files/s); found %d images.' \
+              %(ndirs, nfiles, dt, nfiles/max(dt, 1e-6), nimages)
+
+def list_directory( d ):
+    """
+    Lists the folder d, returning (subdirs, fnames), both sorted.
+    Symlinks to folders end up in fnames and are never descended into.
+    Uses scandir when it is available (python 3.5+ or the scandir package),
+     which avoids a stat() call per entry on most filesystems.
+    """
+    subdirs, fnames = [], []
+    if scandir != None:
+        for e in scandir( d ):
+            if e.is_dir( follow_symlinks=False ):
+                subdirs.append( e.name )
+            else:
+                fnames.append( e.name )
+    else:
+        for n in listdir( d ):
+            p = path.join( d, n )
+            if path.isdir( p ) and not path.islink( p ):
+                subdirs.append( n )
+            else:
+                fnames.append( n )
+    subdirs.sort()
+    fnames.sort()
+    return subdirs, fnames
+
+def walk_directories( location, nthreads=1, maxqueue=10000 ):
+    """
+    Walks <location> top-down like os.walk, yielding (folder, subdirs, fnames).
+    Unreadable folders are silently skipped.
+
+    If nthreads > 1, folders are listed by a pool of threads sharing a work queue
+     of at most <maxqueue> folders (a thread that finds the queue full walks the
+     new folders itself), and results come out in no particular order.
+     Listing a folder releases the GIL, so this scales with the number of threads
+     until the disks are saturated.
+    """
+    location = location.rstrip('/') or '/'
+    if nthreads <= 1:
+        stack = [location]
+        while stack:
+            d = stack.pop()
+            try:
+                subdirs, fnames = list_directory( d )
+            except OSError:
+                continue
+            yield d, subdirs, fnames
+            stack.extend( [path.join(d, sd) for sd in reversed(subdirs)] )
+        return
+
+    todo = Queue.Queue( maxqueue )
+    done = Queue.Queue( maxqueue )
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending = [1]  # folders queued but not yet fully handled
+    todo.put( location )
+
+    def put( q, item ):
+        # blocking put that gives up once the consumer has gone away
+        while not stop.is_set():
+            try:
+                q.put( item, timeout=0.1 )
+                return
+            except Queue.Full:
+                pass
+
+    errors = []  # exc_info of any worker that died
+
+    def worker():
+        mine = []
+        finished = False
+        try:
+            while not stop.is_set():
+                if mine:
+                    d = mine.pop()
+                else:
+                    try:
+                        d = todo.get( timeout=0.1 )
+                    except Queue.Empty:
+                        continue
+                try:
+                    subdirs, fnames = list_directory( d )
+                except OSError:
+                    subdirs, fnames = [], []
+                else:
+                    with lock:
+                        pending[0] += len(subdirs)
+                    for sd in subdirs:
+                        try:
+                            todo.put_nowait( path.join(d, sd) )
+                        except Queue.Full:
+                            mine.append( path.join(d, sd) )
+                    put( done, (d, subdirs, fnames) )
+                with lock:
+                    pending[0] -= 1
+                    finished = (pending[0] == 0)
+                if finished:
+                    break
+        except:
+            errors.append( sys.exc_info() )
+            finished = True
+        finally:
+            # the walk can never finish without this worker, so always wake up the reader
+            if finished:
+                put( done, None )
+
+    threads = [threading.Thread( target=worker ) for i in range(nthreads)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        while True:
+            item = done.get()
+            if item == None:
+                break
+            yield item
+        if errors:
+            t, v, tb = errors[0]
+            raise t, v, tb
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+def read_fits_header( f, keys=None ):
+    """
+    Reads the primary header of a FITS file without opening the whole thing:
+     only the 2880-byte header blocks up to the END card are read.
+    <f> can be a path or an open file-like object.
+    If <keys> is given, only those keywords are parsed (case insensitive).
+
+    Returns a dictionary of {KEYWORD: value}, with values converted to str, int,
+     float or bool as pyfits would (keywords with no value map to None).
+    Raises IOError if this is not an (uncompressed) FITS file or END is never found.
+    """
+    if keys != None:
+        keys = set( [k.upper() for k in keys] )
+    if isinstance( f, basestring ):
+        fobj = open( f, 'rb' )
+    else:
+        fobj = f
+    try:
+        head = {}
+        first = True
+        while True:
+            # most of our headers fit in 4 blocks, so try to get it all in one read
+            chunk = fobj.read( FITS_BLOCK*4 )
+            if len(chunk) < FITS_BLOCK:
+                raise IOError( 'END card not found in FITS header' )
+            chunk = chunk[ : len(chunk) - len(chunk)%FITS_BLOCK ]
+            if first and not chunk.startswith( 'SIMPLE  =' ):
+                raise IOError( 'not a FITS file' )
+            first = False
+            for i in xrange( 0, len(chunk), 80 ):
+                card = chunk[i:i+80]
+                key = card[:8].rstrip()
+                if key == 'END':
+                    return head
+                if (card[8:10] != '= ') or (key in head) or ((keys != None) and (key not in keys)):
+                    continue
+                head[key] = _parse_fits_value( card[10:] )
+    finally:
+        if fobj is not f:
+            fobj.close()
+
+def _parse_fits_value( s ):
+    """
+    Parses the value field of a FITS header card (everything after '= ').
+    """
+    s = s.strip()
+    if s.startswith( "'" ):
+        # a string: runs to the next single quote that is not doubled
+        i = 1
+        out = []
+        while i < len(s):
+            if s[i] == "'":
+                if s[i+1:i+2] == "'":
+                    out.append( "'" )
+                    i += 2
+                    continue
+                break
+            out.append( s[i] )
+            i += 1
+        return ''.join( out ).rstrip()
+    s = s.split( '/' )[0].strip()
+    if s == '':
+        return None
+    if s == 'T':
+        return True
+    if s == 'F':
+        return False
+    try:
+        return int( s )
+    except ValueError:
+        pass
+    try:
+        return float( s.replace('D','E') )
+    except ValueError:
+        return s
+
+def open_compressed( fname ):
+    """
+    Opens a gzip (.gz) or unix compress (.Z) file for streaming reads: data are
+     only decompressed as they are read, so reading a FITS header out of a
+     compressed image never decompresses the image itself.
+    Raises IOError if the file is neither.
+    """
+    f = open( fname, 'rb' )
+    magic = f.read( 2 )
+    f.seek( 0 )
+    if magic == '\x1f\x8b':
+        return gzip.GzipFile( fileobj=f )
+    elif magic == '\x1f\x9d':
+        return LZWReader( f )
+    f.close()
+    raise IOError( '%s is not a gzip or compress file' %fname )
+
+class LZWReader( object ):
+    """
+    A file-like object that decodes a unix compress (.Z, LZW) stream as it is read.
+    Follows Mark Adler's unlzw (from pigz), including the quirk that compress pads
+     the input to a multiple of <bits> bytes whenever the code size changes.
+    """
+    def __init__( self, fobj ):
+        self.f = fobj
+        head = fobj.read( 3 )
+        if (len(head) < 3) or (head[:2] != '\x1f\x9d'):
+            raise IOError( 'not a compress (.Z) file' )
+        flags = ord( head[2] )
+        self.maxbits = flags & 0x1f
+        self.block = flags & 0x80
+        if (self.maxbits < 9) or (self.maxbits > 16):
+            raise IOError( 'bad code size in compress (.Z) file' )
+        self.prefix = [0]*(1 << self.maxbits)
+        self.suffix = [0]*(1 << self.maxbits)
+        self.bits, self.mask = 9, 0x1ff
+        self.end = 256 if self.block else 255  # last code in the table
+        self.prev = self.final = None
+        self.buf, self.left = 0, 0  # bit buffer and how many bits are in it
+        self.inbuf, self.inpos = '', 0
+        self.nread, self.mark = 0, 0  # input bytes used, and where this code size started
+        self.out, self.nout = [], 0   # decoded but not yet read
+        self.eof = False
+
+    def _byte( self ):
+        if self.inpos >= len(self.inbuf):
+            self.inbuf, self.inpos = self.f.read( 8192 ), 0
+            if not self.inbuf:
+                return None
+        self.inpos += 1
+        self.nread += 1
+        return ord( self.inbuf[self.inpos-1] )
+
+    def _align( self ):
+        # skip ahead to the next multiple of <bits> bytes since the mark
+        rem = (self.nread - self.mark) % self.bits
+        if rem:
+            for i in xrange( self.bits - rem ):
+                if self._byte() == None:
+                    break
+        self.buf, self.left = 0, 0
+        self.mark = self.nread
+
+    def _code( self ):
+        while self.left < self.bits:
+            b = self._byte()
+            if b == None:
+                return None
+            self.buf |= b << self.left
+            self.left += 8
+        code = self.buf & self.mask
+        self.buf >>= self.bits
+        self.left -= self.bits
+        return code
+
+    def _decode( self ):
+        """
+        Decodes a single code into self.out; sets self.eof at the end of the data.
+        """
+        if self.prev == None:
+            # the first code is always a literal
+            code = self._code()
+            if code == None:
+                self.eof = True
+                return
+            if code > 255:
+                raise IOError( 'corrupt compress (.Z) file' )
+            self.prev = self.final = code
+            self.out.append( chr(code) )
+            self.nout += 1
+            return
+        if (self.end >= self.mask) and (self.bits < self.maxbits):
+            self._align()
+            self.bits += 1
+            self.mask = (self.mask << 1) | 1
+        code = self._code()
+        if code == None:
+            self.eof = True
+            return
+        if (code == 256) and self.block:
+            # table reset
+            self._align()
+            self.bits, self.mask, self.end = 9, 0x1ff, 255
+            return
+        temp = code
+        stack = []
+        if code > self.end:
+            # the one code that is allowed to refer to the entry being built
+            if (code != self.end + 1) or (self.prev > self.end):
+                raise IOError( 'corrupt compress (.Z) file' )
+            stack.append( self.final )
+            code = self.prev
+        while code >= 256:
+            stack.append( self.suffix[code] )
+            code = self.prefix[code]
+        stack.append( code )
+        self.final = code
+        if self.end < self.mask:
+            self.end += 1
+            self.prefix[self.end] = self.prev
+            self.suffix[self.end] = self.final
+        self.prev = temp
+        stack.reverse()
+        self.out.append( ''.join( map(chr, stack) ) )
+        self.nout += len(stack)
+
+    def read( self, n=-1 ):
+        while ((n < 0) or (self.nout < n)) and not self.eof:
+            self._decode()
+        data = ''.join( self.out )
+        if n < 0:
+            n = len(data)
+        self.out = [ data[n:] ]
+        self.nout = len(data) - n
+        return data[:n]
+
+    def close( self ):
+        self.f.close()
 
-def get_info_image_fitsfile( fitsfile ):
+def get_info_image_fitsfile( fitsfile, use_cache=True ):
     """
     Takes in the path to an image fitsfile and attempts to pull
      from it several useful bits of information.
+    If use_cache == True, results are kept in (and read back from) the
+     persistent header cache (see header_cache.py).
     
     Returns a dictionary containing the relevant header items.
     """
-    try:
-        hdu = pf.open( fitsfile )
-    except IOError:
-        # probably a zcatted file
-        p = Popen(["zcat", fitsfile], stdout=PIPE)
-        hdu = pf.open( StringIO(p.communicate()[0]) )
-    hdu.verify('fix')
-    head = hdu[0].header
-    
+    cache = header_cache.get_cache() if use_cache else None
+    if cache != None:
+        outdict = cache.get( fitsfile, 'image', HEADER_INFO_VERSION )
+        if outdict != None:
+            return outdict
     ks = [ ['object','object'],
            ['ra','ra'],
            ['dec','dec'],
@@ -116,11 +620,28 @@ def get_info_image_fitsfile( fitsfile ):
            ['observer','observer'],
            ['filter','filters'],
            ['filter2','filtnam'] ]
+
+    try:
+        head = read_fits_header( fitsfile, keys=[k for _,k in ks] )
+    except IOError:
+        # probably a compressed file; decompress only as far as the END card
+        try:
+            f = open_compressed( fitsfile )
+            try:
+                head = read_fits_header( f, keys=[k for _,k in ks] )
+            finally:
+                f.close()
+        except (IOError, zlib.error):
+            # something odd; let pyfits have a go at it
+            hdu = pf.open( fitsfile )
+            hdu.verify('fix')
+            head = hdu[0].header
+            hdu.close()
     
     outdict = {}
     for outk, fitsk in ks:
         try:
-            val = head[fitsk]
+            val = head[fitsk.upper()]
         except:
             val = None
         if val == None:
@@ -143,18 +664,24 @@ def get_info_image_fitsfile( fitsfile ):
                 pass
         outdict[outk] = val
 
+    if cache != None:
+        cache.put( fitsfile, 'image', outdict, HEADER_INFO_VERSION )
     return outdict    
 
-def get_info_spec_fitsfile( fitsfile ):
+def get_info_spec_fitsfile( fitsfile, use_cache=True ):
     """
     Takes in the path to a spectrum fitsfile and attempts to pull 
      from it several useful bits of information.
+    If use_cache == True, results are kept in (and read back from) the
+     persistent header cache (see header_cache.py).
     
     Returns a dictionary of values.
     """
-    hdu = pf.open( fitsfile )
-    head = hdu[0].header
-    
+    cache = header_cache.get_cache() if use_cache else None
+    if cache != None:
+        outdict = cache.get( fitsfile, 'spec', HEADER_INFO_VERSION )
+        if outdict != None:
+            return outdict
     ks = [ ['object','object'],
            ['ra','ra'],
            ['dec','dec'],
@@ -174,11 +701,19 @@ def get_info_spec_fitsfile( fitsfile ):
            ['seeing','seeing'],
            ['position_ang', 'tub'],
            ['parallac_ang', 'opt_pa'] ]
+
+    try:
+        head = read_fits_header( fitsfile, keys=[k for _,k in ks] )
+    except IOError:
+        # not a plain FITS file; let pyfits have a go at it
+        hdu = pf.open( fitsfile )
+        head = hdu[0].header
+        hdu.close()
     
     outdict = {}
     for outk, fitsk in ks:
         try:
-            val = head[fitsk]
+            val = head[fitsk.upper()]
         except:
             val = None
         if val == None:
@@ -206,8 +741,89 @@ def get_info_spec_fitsfile( fitsfile ):
             outdict[outk] = 'LRIS'
         elif 'deimos' in outdict[outk].lower():
             outdict['observatory'] = 'Keck 2, 10m'
+    if cache != None:
+        cache.put( fitsfile, 'spec', outdict, HEADER_INFO_VERSION )
     return outdict
 
+# columns of the tables built by extract_headers: (name, type), where type is
+#  'f' (float, NaN if missing), 'S' (string, '' if missing) or 'D' (datetime, as an ISO string)
+IMAGE_HEADER_COLUMNS = [ ('object','S'), ('ra','S'), ('dec','S'), ('ra_d','f'), ('dec_d','f'),
+                         ('exptime','f'), ('exptime2','f'), ('date','D'), ('dateobs','D'), ('utc','f'),
+                         ('date_mjd','f'), ('airmass','f'), ('telescope','S'), ('instrument','S'),
+                         ('observer','S'), ('filter','S'), ('filter2','S') ]
+SPEC_HEADER_COLUMNS = [ ('object','S'), ('ra','S'), ('dec','S'), ('ra_d','f'), ('dec_d','f'),
+                        ('exptime','f'), ('date','D'), ('date2','D'), ('utc','S'), ('date_mjd','f'),
+                        ('airmass','f'), ('observatory','S'), ('instrument','S'), ('instrument2','S'),
+                        ('observer','S'), ('reducer','S'), ('seeing','f'), ('position_ang','f'),
+                        ('parallac_ang','f') ]
+
+def _extract_header_row( args ):
+    """
+    Worker for extract_headers: returns (path, error message or '', info dict).
+    """
+    fitsfile, kind = args
+    try:
+        if kind == 'image':
+            return fitsfile, '', get_info_image_fitsfile( fitsfile )
+        else:
+            return fitsfile, '', get_info_spec_fitsfile( fitsfile )
+    except Exception, e:
+        return fitsfile, '%s: %s' %(type(e).__name__, e), {}
+
+def extract_headers( paths, kind='image', nprocs=None, chunksize=32 ):
+    """
+    Pulls the header info out of many fitsfiles at once, using a pool of <nprocs>
+     processes (default: one per core; nprocs=1 runs in this process).
+    <paths> can be any iterable of paths, e.g. yield_all_images().
+    <kind> is 'image' (uses get_info_image_fitsfile) or 'spec' (get_info_spec_fitsfile).
+
+    Returns a NumPy structured array with one row per input file, in input order:
+     path, ok, error, and then the typed columns in IMAGE_HEADER_COLUMNS or
+     SPEC_HEADER_COLUMNS.  Files that could not be read are kept as rows with
+     ok == False and the exception in error.
+
+    Example:
+     > t = extract_headers( yield_all_images(nthreads=8), nprocs=8 )
+     > t[ t['ok'] & (t['exptime'] > 300) ]['path']
+    """
+    if kind not in ['image', 'spec']:
+        raise ValueError, "kind must be 'image' or 'spec'"
+    columns = IMAGE_HEADER_COLUMNS if kind == 'image' else SPEC_HEADER_COLUMNS
+    jobs = ( (p, kind) for p in paths )
+    if nprocs == 1:
+        rows = map( _extract_header_row, jobs )
+    else:
+        pool = Pool( nprocs )
+        try:
+            rows = list( pool.imap( _extract_header_row, jobs, chunksize ) )
+        finally:
+            pool.close()
+            pool.join()
+
+    arrays = [ np.array( [r[0] for r in rows], dtype=str ),
+               np.array( [r[1] == '' for r in rows], dtype=bool ),
+               np.array( [r[1] for r in rows], dtype=str ) ]
+    names = ['path', 'ok', 'error']
+    for name, typ in columns:
+        vals = [r[2].get( name ) for r in rows]
+        if typ == 'f':
+            col = np.empty( len(vals), dtype='f8' )
+            for i,v in enumerate( vals ):
+                try:
+                    col[i] = float( v )
+                except (TypeError, ValueError):
+                    col[i] = np.nan
+        else:
+            if typ == 'D':
+                vals = [v.isoformat() if hasattr(v, 'isoformat') else v for v in vals]
+            col = np.array( ['' if v == None else str(v) for v in vals], dtype=str )
+        arrays.append( col )
+        names.append( name )
+    table = np.empty( len(rows), dtype=[(n, a.dtype) for n,a in zip(names, arrays)] )
+    for n,a in zip( names, arrays ):
+        table[n] = a
+    return table
+
 def parse_filename( f ):
     """
     Parses a *.flm file for observation date and object name.
@@ -254,9 +870,114 @@ def parse_dec( inn ):
     except:
         # try to parse with phmsdms:
         res = parse_sexagesimal(inn)
-        dec = res['sign']*( res['vals'][0] + res['vals'][1]/60. + res['vals'][2]/3600. )
+        sign = res['sign']
+        if inn.strip().startswith('-'):
+            # catches -00:MM:SS, where the degrees alone do not carry the sign
+            sign = -1
+        dec = sign*( res['vals'][0] + res['vals'][1]/60. + res['vals'][2]/3600. )
         return dec
 
+def parse_ra_array( inn ):
+    '''
+    Array version of parse_ra: parses a sequence of RA strings and returns a NumPy
+     array of decimal degrees.
+    Rows like HH:MM:SS.ss and plain decimal degrees are handled in a vectorized
+     fast path; anything else goes through parse_ra one row at a time, so results
+     are identical.  Rows that parse_ra cannot handle come back as NaN.
+    '''
+    return _parse_coord_array( inn, parse_ra, 15., False )
+
+def parse_dec_array( inn ):
+    '''
+    Array version of parse_dec: parses a sequence of Dec strings and returns a NumPy
+     array of decimal degrees.
+    Rows like +DD:MM:SS.s (sign optional) and plain decimal degrees are handled in a
+     vectorized fast path; anything else goes through parse_dec one row at a time,
+     so results are identical.  Rows that parse_dec cannot handle come back as NaN.
+    '''
+    return _parse_coord_array( inn, parse_dec, 1., True )
+
+def _parse_coord_array( inn, scalar_parser, scale, signed ):
+    """
+    Does the work for parse_ra_array and parse_dec_array.
+    """
+    orig = list( inn )
+    n = len(orig)
+    out = np.empty( n )
+    out.fill( np.nan )
+    if n == 0:
+        return out
+    strs = []
+    for v in orig:
+        try:
+            strs.append( str(v) )
+        except UnicodeEncodeError:
+            strs.append( '' )  # leave it to the slow path
+    a = np.char.strip( np.array( strs, dtype='S' ) )
+    width = max( a.dtype.itemsize, 1 )
+    a = a.astype( 'S%d' %width )
+    b = a.view( np.uint8 ).reshape( n, width )
+
+    # sexagesimal fast path, with any leading sign stripped off
+    sign = np.ones( n )
+    bs = b
+    if signed:
+        neg = (b[:,0] == ord('-'))
+        shift = neg | (b[:,0] == ord('+'))
+        if shift.any():
+            bs = b.copy()
+            bs[shift,:-1] = b[shift,1:]
+            bs[shift,-1] = 0
+            sign[neg] = -1.
+    vals, ok = _sexagesimal_fast( bs )
+    out[ok] = scale*sign[ok]*vals[ok]
+
+    # decimal fast path
+    isnum = ((b >= ord('0')) & (b <= ord('9'))) | (b == 0)
+    for c in '.+-eE':
+        isnum |= (b == ord(c))
+    cand = (~ok) & isnum.all(axis=1) & (b[:,0] != 0)
+    if cand.any():
+        try:
+            out[cand] = a[cand].astype( float )
+            ok |= cand
+        except ValueError:
+            pass
+
+    # everything else, one at a time
+    for i in np.where( ~ok )[0]:
+        try:
+            out[i] = scalar_parser( orig[i] )
+        except Exception:
+            pass
+    return out
+
+def _sexagesimal_fast( b ):
+    """
+    Parses the rows of an (n, width) uint8 array of unsigned, null-padded strings
+     that are laid out exactly like DD:MM:SS[.sss].
+    Returns (values in units of the first field, boolean mask of the rows parsed).
+    """
+    n, width = b.shape
+    out = np.zeros( n )
+    if width < 8:
+        return out, np.zeros( n, dtype=bool )
+    isdigit = (b >= ord('0')) & (b <= ord('9'))
+    ok = isdigit[:,0] & isdigit[:,1] & (b[:,2] == ord(':')) & isdigit[:,3] & isdigit[:,4] & \
+         (b[:,5] == ord(':')) & isdigit[:,6] & isdigit[:,7]
+    # the rest of the seconds field can only be digits, one decimal point, and padding
+    rest, restdigit = b[:,8:], isdigit[:,8:]
+    ok &= (restdigit | (rest == ord('.')) | (rest == 0)).all(axis=1) & ((rest == ord('.')).sum(axis=1) <= 1)
+    # and no digits after the padding starts
+    padded = np.cumsum( rest == 0, axis=1 ) > 0
+    ok &= ~(padded & restdigit).any(axis=1)
+    if not ok.any():
+        return out, ok
+    d = b[ok].astype( float ) - ord('0')
+    secs = np.ascontiguousarray( b[ok][:,6:] ).view( 'S%d' %(width-6) ).ravel().astype( float )
+    out[ok] = (d[:,0]*10. + d[:,1]) + (d[:,3]*10. + d[:,4])/60. + secs/3600.
+    return out, ok
+
 def parse_sexagesimal(hmsdms):
     """
     +++ Pulled from python package 'angles' +++
@@ -381,15 +1102,47 @@ def parse_sexagesimal(hmsdms):
     return dict(sign=sign, units=units, vals=vals, parts=parts)
 
 
-def getSNID( flmfile ):
+def getSNID( flmfile, workdir=None, snid=None, use_cache=True ):
     """
     Run SNID on an ASCII spectrum,
      simply returning the best type as 
      determined by fraction and slope.
+    SNID is run inside <workdir> (default: the current folder), where it leaves its
+     output files, using the executable <snid> (default: SNID_CMD).
+    If use_cache == True (default), a spectrum with the same contents that has already
+     been run through the same snid and templates is not run again (see snid_cache.py).
+    """
+    if snid == None:
+        snid = SNID_CMD
+    options = 'plot=0 inter=0'
+    cache = snid_cache.get_cache() if use_cache else None
+    try:
+        # no fingerprint means the templates could not be found, and nothing is cached
+        fprint = snid_cache.fingerprint( snid ) if cache != None else None
+        if fprint == None:
+            cache = None
+        if cache != None:
+            key = (snid_cache.content_hash( flmfile ), fprint, options)
+            cached = cache.get( *key )
+            if cached != None:
+                return cached[0], cached[1]
+        cmd = "{} {} {}".format(snid, options, path.abspath(flmfile))
+        p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, cwd=workdir)
+        o,e = p.communicate()
+        t, st = parse_snid_output( o )
+        # only keep the answer if snid actually ran
+        if (cache != None) and (p.returncode == 0) and o:
+            cache.put( *(key + (t, st, o)) )
+        return t, st
+    except:
+        return 'NoMatch','NoMatch'
+
+def parse_snid_output( o ):
+    """
+    Pulls the best type and subtype (by fraction and slope) out of SNID's
+     printed output.  Returns ('NoMatch','NoMatch') if there are none.
     """
     try:
-        cmd = "snid plot=0 inter=0 {}".format(flmfile)
-        o,e = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE).communicate()
         # if SNID found no matches at all, quit here
         if re.search('Thank you for using SNID! Goodbye.',o) == None:
             return 'NoMatch','NoMatch'
@@ -426,6 +1179,47 @@ def getSNID( flmfile ):
     except:
         return 'NoMatch','NoMatch'
 
+SMOOTH_WINDOWS = ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']
+# tapered windows at least this long are convolved by FFT rather than directly
+FFT_MIN_WINDOW = 256
+_KERNELS = {}  # (window, window_len): normalized kernel
+
+def window_kernel( window, window_len ):
+    """
+    Returns the normalized <window> kernel of length window_len (cached).
+    """
+    key = (window, window_len)
+    if key not in _KERNELS:
+        if window == 'flat': #moving average
+            w = np.ones(window_len,'d')
+        else:
+            w = getattr( np, window )( window_len )
+        _KERNELS[key] = w/w.sum()
+    return _KERNELS[key]
+
+def _smooth_rows( y, window_len, window ):
+    """
+    Smooths each row of the 2D array y with a <window> kernel window_len pixels long,
+     reflecting the ends as smooth does.  Flat windows use a running sum, long tapered
+     windows an FFT, and the rest np.convolve.
+    """
+    nrows, n = y.shape
+    if window_len < 3:
+        return y
+    s = np.concatenate( [y[:,window_len-1:0:-1], y, y[:,-1:-window_len:-1]], axis=1 )
+    if window == 'flat':
+        cs = np.concatenate( [np.zeros((nrows,1)), np.cumsum(s, axis=1)], axis=1 )
+        out = (cs[:,window_len:] - cs[:,:-window_len]) / window_len
+    elif window_len >= FFT_MIN_WINDOW:
+        k = window_kernel( window, window_len )
+        nfft = 2**int(np.ceil(np.log2( s.shape[1] + window_len - 1 )))
+        full = np.fft.irfft( np.fft.rfft(s, nfft, axis=1) * np.fft.rfft(k, nfft), nfft, axis=1 )
+        out = full[:, window_len-1:s.shape[1]]
+    else:
+        k = window_kernel( window, window_len )
+        out = np.array( [np.convolve(k, row, mode='valid') for row in s] )
+    return out[:, window_len/2 : window_len/2 + n]
+
 def smooth( x, y, width, window='hanning' ):
     '''
     Smooth the input spectrum y (on wl x) with a <window> kernel
@@ -437,7 +1231,7 @@ def smooth( x, y, width, window='hanning' ):
         raise ValueError, "smooth only accepts 1 dimension arrays."
     if x.size != y.size:
         raise ValueError, "Input x,y vectors must be of same size"
-    if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
+    if not window in SMOOTH_WINDOWS:
         raise ValueError, "Window must be one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'"
     avg_width = np.abs(np.mean(x[1:]-x[:-1]))
     window_len = int(round(width/avg_width))
@@ -445,21 +1239,183 @@ def smooth( x, y, width, window='hanning' ):
         raise ValueError, "Input vector needs to be bigger than window size."
     if window_len<3:
         return y
+    return _smooth_rows( y[np.newaxis,:], window_len, window )[0]
 
-    s=np.r_[y[window_len-1:0:-1],y,y[-1:-window_len:-1]]
+def snr_batch( spectra, wsig=100, wnoise=500, window='hanning' ):
+    """
+    Estimates the average S/N ratio (as getSNR does) for many spectra at once.
+    <spectra> is a list of .flm paths, Spectrum objects, or (wl, flux) array pairs.
+    Spectra with the same number of pixels and window lengths are smoothed together
+     as one 2D array.
+    Returns an array of SNRs, with NaN for any spectrum that could not be handled.
+     > snrs = snr_batch( [row['Filepath']+'/'+row['Filename'] for row in rows] )
+    """
+    snrs = np.empty( len(spectra) )
+    snrs.fill( np.nan )
+    groups = {}
+    for i, s in enumerate( spectra ):
+        try:
+            if isinstance( s, basestring ):
+                s = load_spectrum( s )
+            if isinstance( s, Spectrum ):
+                x, y = s.wl, s.flux
+            else:
+                x, y = np.asarray(s[0], dtype=float), np.asarray(s[1], dtype=float)
+            good = ~np.isnan( y )
+            x, y = x[good], y[good]
+            avg_width = np.abs(np.mean(x[1:]-x[:-1]))
+            lsig, lnoise = int(round(wsig/avg_width)), int(round(wnoise/avg_width))
+        except (IOError, OSError, ValueError, IndexError), e:
+            print 'Cannot estimate SNR for spectrum %d: %s' %(i, e)
+            continue
+        if y.size < max( lsig, lnoise ):
+            continue
+        groups.setdefault( (y.size, lsig, lnoise), [] ).append( (i, y) )
+    for (n, lsig, lnoise), members in groups.items():
+        rows = [i for i,_ in members]
+        y = np.array( [y for _,y in members] )
+        sig = _smooth_rows( y, lsig, window )
+        noise = _smooth_rows( np.abs( y - sig ), lnoise, window )
+        snrs[rows] = np.mean( sig/noise, axis=1 )
+    return snrs
 
-    if window == 'flat': #moving average
-        w=np.ones(window_len,'d')
-    else:
-        w=eval('np.'+window+'(window_len)')
+def read_flm( flmfile ):
+    """
+    Reads an ascii spectrum (columns of wavelength, flux and perhaps error) into
+     a 2D array, like np.loadtxt( flmfile ) but several times faster.
+    Falls back on np.loadtxt for anything unusual, so a badly formatted file
+     raises the same errors it always has.
+    """
+    text = open( flmfile, 'rb' ).read()
+    if '#' in text:
+        text = '\n'.join( [l.split('#')[0] for l in text.splitlines()] )
+    lines = [l for l in text.splitlines() if l.strip()]
+    if len(lines) > 1:
+        ncols = len( lines[0].split() )
+        # a ragged file can still have the right number of values in all, so count every row
+        if ncols and all( [len( l.split() ) == ncols for l in lines] ):
+            d = np.fromstring( text, sep=' ' )
+            if d.size == ncols*len(lines):
+                return d.reshape( (len(lines), ncols) )
+    return np.loadtxt( flmfile )
 
-    y=np.convolve(w/w.sum(),s,mode='valid')
-    yout = y[(window_len/2):-(window_len/2)]
-    if len(yout) < len(x):
-        yout = y[(window_len/2):-(window_len/2)+1]
-    elif len(yout) > len(x):
-        yout = y[(window_len/2):-(window_len/2)-1]
-    return yout
+class Spectrum( object ):
+    """
+    A spectrum read from a .flm file, parsed once; everything derived from it
+     (SNR, wavelength range, resolution) is computed when first asked for and kept.
+     > s = load_spectrum( '/media/raid0/Data/spectra/sn2016abc/sn2016abc-20160101.flm' )
+     > s.snr()
+     > s.info()
+    If use_store == True (default), files in the archive are read from (and added to)
+     the binary spectrum store (see spectrum_store.py) instead of parsed.
+    """
+    def __init__( self, flmfile, use_store=True ):
+        self.flmfile = flmfile
+        self.use_store = use_store
+        self._data = None
+        self._snr = {}
+
+    @property
+    def data( self ):
+        if self._data is None:
+            self._data = self._load()
+        return self._data
+
+    def _load( self ):
+        if not self.use_store:
+            return read_flm( self.flmfile )
+        try:
+            store = spectrum_store.get_store()
+            key = store.key_for( self.flmfile )
+            d = store.get( key ) if key != None else None
+        except Exception:
+            # a broken store should never stop us reading the file itself
+            key, d = None, None
+        if d is None:
+            d = read_flm( self.flmfile )
+            if key != None:
+                try:
+                    store.put( key, d )
+                except Exception:
+                    pass
+        return d
+
+    @property
+    def wl( self ):
+        return self.data[:,0]
+
+    @property
+    def flux( self ):
+        return self.data[:,1]
+
+    def snr( self, wsig=100, wnoise=500 ):
+        """
+        Estimates the average S/N ratio (see getSNR).
+        """
+        if (wsig, wnoise) not in self._snr:
+            d = self.data[ ~np.isnan(self.data[:,1]) ]
+            sig, n, noise = _snr_curves( d, wsig, wnoise )
+            self._snr[(wsig, wnoise)] = np.mean( sig/noise )
+        return self._snr[(wsig, wnoise)]
+
+    def info( self ):
+        """
+        Returns the dictionary of get_info_spec_flmfile.
+        """
+        d = self.data
+        outd = {}
+        outd['SNR'] = self.snr()
+        outd['MinWL'] = d[0,0]
+        outd['MaxWL'] = d[-1,0]
+        # take average resolutions of 10 pixels on either end for red/blue resolutions
+        outd['BlueRes'] = np.mean(d[:,0][1:11] - d[:,0][0:10])
+        outd['RedRes'] = np.mean(d[:,0][-10:] - d[:,0][-11:-1])
+        return outd
+
+_SPECTRA = []  # recently loaded [(path, size, mtime), Spectrum], most recent last
+MAX_SPECTRA = 32
+
+def load_spectrum( flmfile, use_store=True ):
+    """
+    Returns the Spectrum for flmfile, reusing the one loaded earlier (this session)
+     if the file has not changed since.
+    """
+    st = stat( flmfile )
+    key = (path.abspath( flmfile ), st.st_size, st.st_mtime)
+    for i, (k, s) in enumerate( _SPECTRA ):
+        if k == key:
+            _SPECTRA.append( _SPECTRA.pop(i) )
+            return s
+    s = Spectrum( flmfile, use_store )
+    _SPECTRA.append( (key, s) )
+    if len(_SPECTRA) > MAX_SPECTRA:
+        _SPECTRA.pop( 0 )
+    return s
+
+def build_spectrum_store( location='/media/raid0/Data/spectra/', nthreads=4, store=None ):
+    """
+    Converts every .flm file below <location> that is not yet (or no longer
+     correctly) in the binary spectrum store (default: spectrum_store.get_store()).
+    Returns (number converted, number that could not be parsed).
+    """
+    if store == None:
+        store = spectrum_store.get_store()
+    keys = []
+    for root, subdirs, fnames in walk_directories( location, nthreads ):
+        for f in fnmatch.filter( fnames, '*.flm' ):
+            key = store.key_for( path.join(root, f) )
+            if key != None:
+                keys.append( key )
+    return store.convert( keys, read_flm )
+
+def _snr_curves( d, wsig, wnoise ):
+    """
+    Returns the signal, |data - signal| and noise curves getSNR uses for data d.
+    """
+    sig = smooth( d[:,0], d[:,1], wsig )
+    n = np.abs( d[:,1] - sig )
+    noise = smooth( d[:,0], n, wnoise )
+    return sig, n, noise
 
 def getSNR( flmfile, wsig=100, wnoise=500, plot=False ):
     """
@@ -467,12 +1423,10 @@ def getSNR( flmfile, wsig=100, wnoise=500, plot=False ):
     <wsig>: the smoothing window used to estimate the signal (A)
     <wnoise>: the smoothing window used to average the noise (A)
     """
-    d = np.loadtxt( flmfile )
-    d = d[ ~np.isnan(d[:,1]) ] 
-    sig = smooth( d[:,0], d[:,1], wsig )
-    n = np.abs( d[:,1] - sig )
-    noise = smooth( d[:,0], n, wnoise )
+    s = load_spectrum( flmfile )
     if plot:
+        d = s.data[ ~np.isnan(s.data[:,1]) ]
+        sig, n, noise = _snr_curves( d, wsig, wnoise )
         plt.figure()
         plt.plot( d[:,0], d[:,1], 'k', label='data' )
         plt.plot( d[:,0], sig, 'r', label='signal' )
@@ -483,29 +1437,20 @@ def getSNR( flmfile, wsig=100, wnoise=500, plot=False ):
         plt.ylabel('flux')
         plt.title('SNR = %f'% np.mean(sig/noise) )
         plt.show()
-    return np.mean( sig/noise )
+    return s.snr( wsig, wnoise )
 
 def get_info_spec_flmfile( flmfile ):
     """
     Calculates a few things about the input flmfile and returns them as a dictionary.
     """
-    outd = {}
-    outd['SNR'] = getSNR( flmfile )
-    d = np.loadtxt( flmfile )
-    outd['MinWL'] = d[0,0]
-    outd['MaxWL'] = d[-1,0]
-    # take average resolutions of 10 pixels on either end for red/blue resolutions
-    outd['BlueRes'] = np.mean(d[:,0][1:11] - d[:,0][0:10])
-    outd['RedRes'] = np.mean(d[:,0][-10:] - d[:,0][-11:-1])
-    return outd
+    return load_spectrum( flmfile ).info()
 
 def get_host_info_simbad( name ):
     """
     Queries simbad for basic info on a host galaxy.
     Returns a dictionary.
     """
-    simbad_uri = "http://simbad.u-strasbg.fr/simbad/sim-id?output.format=ASCII&Ident=%s"
-    result = urlopen( simbad_uri % name.replace(' ','%20') ).read()
+    result = http_cache.fetch( SIMBAD_URI % name.replace(' ','%20'), 'simbad', SIMBAD_NOT_FOUND )
     
     outd = {}
     # get the type of the host galaxy
@@ -525,15 +1470,14 @@ def get_host_info_simbad( name ):
         pass
     return outd
         
-def get_SN_info_simbad( name ):
+def get_SN_info_simbad( name, host_info=True ):
     """
     Queries simbad for SN coords, redshift, and host galaxy.
     If redshift is not given for SN, attempts to resolve link to 
-     host galaxy and report its redshift.
+     host galaxy and report its redshift (unless host_info == False).
     Returns a dictionary.
     """
-    simbad_uri = "http://simbad.u-strasbg.fr/simbad/sim-id?output.format=ASCII&Ident=%s"
-    result = urlopen( simbad_uri % name.replace(' ','%20') ).read()
+    result = http_cache.fetch( SIMBAD_URI % name.replace(' ','%20'), 'simbad', SIMBAD_NOT_FOUND )
     outd = {}
 
     # try to get the coordinates
@@ -578,7 +1522,7 @@ def get_SN_info_simbad( name ):
     except AttributeError:
         host = None
         pass
-    if host != None:
+    if host_info and (host != None):
         hostd = get_host_info_simbad( host )
         outd.update( hostd )
 
@@ -589,6 +1533,68 @@ def get_SN_info_simbad( name ):
         pass
     return outd
 
+def angular_separation( ra1, dec1, ra2, dec2 ):
+    """
+    True angular separation (degrees) between (ra1,dec1) and (ra2,dec2), all in
+     decimal degrees.  Works on scalars or NumPy arrays (haversine formula, so it
+     is well behaved at small separations, across RA=0/360, and at the poles).
+    """
+    ra1, dec1, ra2, dec2 = map( np.radians, [ra1, dec1, ra2, dec2] )
+    h = np.sin( (dec2-dec1)/2. )**2 + np.cos(dec1)*np.cos(dec2)*np.sin( (ra2-ra1)/2. )**2
+    return np.degrees( 2.*np.arcsin( np.sqrt( np.clip(h, 0., 1.) ) ) )
+
+class SkyIndex( object ):
+    """
+    A spatial index over a fixed set of sky positions, for radius and nearest-neighbour
+     queries in true angular separation.
+    Points are kept sorted by Dec, so a query only looks at the band of points within
+     <radius> in Dec (found by binary search) and computes exact separations for those.
+     RA wraparound and the poles need no special handling.
+    Rows with NaN coordinates are left out.
+
+    Example:
+     > idx = SkyIndex( ras, decs )
+     > rows, seps = idx.query_radius( 150.1, 2.2, 1./60 )   # everything within 1 arcmin
+     > rows, seps = idx.query_nearest( 150.1, 2.2, k=5 )    # the 5 closest
+    rows index into the original ras, decs; seps are in degrees, closest first.
+    """
+    def __init__( self, ra, dec ):
+        ra = np.asarray( ra, dtype=float )
+        dec = np.asarray( dec, dtype=float )
+        rows = np.where( np.isfinite(ra) & np.isfinite(dec) )[0]
+        self.rows = rows[ np.argsort( dec[rows], kind='mergesort' ) ]
+        self.ra = ra[self.rows]
+        self.dec = dec[self.rows]
+        self.n = len(self.rows)
+
+    def query_radius( self, ra, dec, radius ):
+        """
+        Returns (rows, separations) of all points within <radius> degrees of (ra, dec).
+        """
+        lo = np.searchsorted( self.dec, dec - radius, 'left' )
+        hi = np.searchsorted( self.dec, dec + radius, 'right' )
+        seps = angular_separation( ra, dec, self.ra[lo:hi], self.dec[lo:hi] )
+        keep = seps <= radius
+        rows, seps = self.rows[lo:hi][keep], seps[keep]
+        order = np.argsort( seps, kind='mergesort' )
+        return rows[order], seps[order]
+
+    def query_nearest( self, ra, dec, k=1 ):
+        """
+        Returns (rows, separations) of the <k> points nearest to (ra, dec).
+        """
+        k = min( k, self.n )
+        if k < 1:
+            return self.rows[:0], np.zeros(0)
+        # start with a radius that holds ~4k points for a uniform sky (pi r^2 = 4k * 4pi/n),
+        #  and grow it until we have k
+        radius = min( np.degrees( np.sqrt( 16.*k/self.n ) ), 180. )
+        while True:
+            rows, seps = self.query_radius( ra, dec, radius )
+            if (len(rows) >= k) or (radius >= 180.):
+                return rows[:k], seps[:k]
+            radius = min( radius*4, 180. )
+
 def remove_tags( row ):
     '''returns row with HTML tags removed, for easy parsing'''
     # strip tags
@@ -604,43 +1610,189 @@ def remove_tags( row ):
                 outstr.append(char)
     return ''.join(outstr)
 
-def download_historical_rochester_info():
+class _TableRowParser( HTMLParser ):
+    """
+    Event-driven parser that picks out the rows of one <table> in an HTML page
+     without building a DOM.  Follows the same rules BeautifulSoup's html.parser
+     tree does: a row is any element directly inside the table, a cell is any
+     element directly inside a row, and an end tag closes everything back to the
+     matching open tag (stray end tags are ignored).
+    Finished rows (lists of cell texts) pile up in self.rows; self.done is set once
+     the table has closed.
+    """
+    def __init__( self, table_index=1 ):
+        HTMLParser.__init__( self )
+        self.table_index = table_index
+        self.ntables = 0
+        self.stack = None   # open tags inside our table (None until we reach it)
+        self.row = None
+        self.rows = []
+        self.done = False
+
+    def _start( self, tag ):
+        """
+        Returns True if this new element is inside our table.
+        """
+        if self.done:
+            return False
+        if self.stack == None:
+            if tag == 'table':
+                if self.ntables == self.table_index:
+                    self.stack = []
+                self.ntables += 1
+            return False
+        depth = len(self.stack)
+        if depth == 0:
+            self.row = []
+        elif depth == 1:
+            self.row.append( [] )
+        return True
+
+    def handle_starttag( self, tag, attrs ):
+        if self._start( tag ):
+            if tag in VOID_TAGS:
+                # never has content or an end tag
+                self._end_depth( len(self.stack) )
+            else:
+                self.stack.append( tag )
+
+    def handle_startendtag( self, tag, attrs ):
+        if self._start( tag ):
+            self._end_depth( len(self.stack) )
+
+    def _end_depth( self, depth ):
+        """
+        Called when an element that sat at <depth> inside the table closes.
+        """
+        if depth == 0:
+            self.rows.append( [u''.join(c) for c in self.row] )
+            self.row = None
+
+    def handle_endtag( self, tag ):
+        if (self.stack == None) or self.done:
+            return
+        if tag not in self.stack:
+            if tag == 'table':
+                # our own table closed
+                if self.row != None:
+                    self._end_depth( 0 )
+                self.done = True
+            return
+        while True:
+            t = self.stack.pop()
+            self._end_depth( len(self.stack) )
+            if t == tag:
+                break
+
+    def handle_data( self, data ):
+        if (self.stack != None) and (not self.done) and (len(self.stack) >= 2):
+            self.row[-1].append( data )
+
+    def handle_entityref( self, name ):
+        if name in name2codepoint:
+            self.handle_data( unichr( name2codepoint[name] ) )
+        else:
+            self.handle_data( u'&%s' %name )
+
+    def handle_charref( self, name ):
+        try:
+            if name[0] in 'xX':
+                c = unichr( int(name[1:], 16) )
+            else:
+                c = unichr( int(name) )
+        except (ValueError, OverflowError):
+            c = u'&#%s;' %name
+        self.handle_data( c )
+
+def _decode_stream( f, chunksize=64*1024 ):
+    """
+    Reads file-like f in chunks, yielding unicode text.  Assumes utf-8, and falls
+     back on windows-1252 for the rest of the stream if that doesn't work.
+    """
+    decoder = codecs.getincrementaldecoder( 'utf-8' )()
+    while True:
+        chunk = f.read( chunksize )
+        if not chunk:
+            break
+        try:
+            yield decoder.decode( chunk )
+        except UnicodeDecodeError:
+            decoder = codecs.getincrementaldecoder( 'cp1252' )()
+            yield decoder.decode( chunk )
+
+def iter_table_rows( f, table_index=1 ):
+    """
+    Streams the HTML page in file-like f (an open file or an http_cache.urlopen response) and yields
+     the rows of table number <table_index> (counting every <table> in document order,
+     from 0) as lists of cell texts, as they are parsed.  Stops reading once the table ends.
+    The equivalent of (for table = soup.findAll('table')[table_index]):
+     > for row in table.findChildren( recursive=False ):
+     >     yield [cell.getText() for cell in row.findChildren( recursive=False )]
+    """
+    p = _TableRowParser( table_index )
+    for text in _decode_stream( f ):
+        p.feed( text )
+        for row in p.rows:
+            yield row
+        p.rows = []
+        if p.done:
+            break
+    else:
+        p.close()
+        for row in p.rows:
+            yield row
+
+def download_historical_rochester_info( source=None, ttl=None ):
     """
     Parse the huge rochester SN page and produce a dictionary akin
      to that produced by download_current_rochester_info.
+    The page is streamed and parsed row by row rather than loaded into BeautifulSoup.
+    <source> can be the path to (or an open copy of) a saved sndateall.html to parse
+     instead of downloading it.
+    <ttl> overrides how old (s) a cached copy of the page may be (see http_cache.py).
     """
-    uri = 'http://www.rochesterastronomy.org/snimages/sndateall.html'
-    page = urlopen( uri ).read()
-    #soup = BeautifulSoup(page)
-    soup = BeautifulSoup(page, "html.parser") # to get rid of warning triggered by above line
-    table = soup.findAll("table")[1]
+    if source == None:
+        uri = ROCHESTER_URI+'sndateall.html'
+        f = http_cache.urlopen( uri, 'rochester', ttl=ttl )
+    elif isinstance( source, basestring ):
+        f = open( source, 'rb' )
+    else:
+        f = source
 
     C_ROCHESTER_DICT = {}
-    rows = table.findChildren( recursive=False )
-    for row in rows[1:]:
-        vals = row.findChildren( recursive=False )
-        if len(vals) == 1:
+    # pull out the text first, so that all the coordinates can be parsed in one go
+    texts = []
+    try:
+        rows = iter_table_rows( f, 1 )
+        next( rows, None )  # the header row
+        for vals in rows:
+            if len(vals) == 1:
+                continue
+            try:
+                texts.append( [vals[i] for i in [0,1,2,6,7,9,10,11]] )
+            except IndexError:
+                pass
+    finally:
+        if f is not source:
+            f.close()
+    ras = parse_ra_array( [t[0] for t in texts] )
+    decs = parse_dec_array( [t[1] for t in texts] )
+    for t, ra, dec in zip( texts, ras, decs ):
+        if np.isnan(ra) or np.isnan(dec):
             continue
+        _, _, date, host, sn_type, mag, name, altName = t
         try:
-            ra = parse_ra( vals[0].getText() )
-            dec = parse_dec( vals[1].getText() )
-            date = vals[2].getText()
-            host = vals[6].getText()
-            sn_type = vals[7].getText()
-            mag = float(vals[9].getText())
-            name = vals[10].getText()
-            altName = vals[11].getText()
-            discoverer = None # not present in this table
-            ref_link = None # not present in this table
-            
-            C_ROCHESTER_DICT[name] = [host, ra, dec, sn_type, ref_link, date, discoverer]
-        except:
+            mag = float(mag)
+        except ValueError:
             # just continue on errors
-            # print row
-            pass
+            continue
+        discoverer = None # not present in this table
+        ref_link = None # not present in this table
+        
+        C_ROCHESTER_DICT[name] = [host, ra, dec, sn_type, ref_link, date, discoverer]
     return C_ROCHESTER_DICT
     
-def download_current_rochester_info():
+def download_current_rochester_info( ttl=None ):
     """
     Parse the current rochester SN page and produce a dictionary including
      all the rows we can understand.
@@ -648,8 +1800,8 @@ def download_current_rochester_info():
      is my best effort to parse most of them, but there are definitely some that
      break this and are not included.  Oh well.
     """
-    uri = 'http://www.rochesterastronomy.org/snimages/snactive.html'
-    page = urlopen( uri ).read()
+    uri = ROCHESTER_URI+'snactive.html'
+    page = http_cache.fetch( uri, 'rochester', ttl=ttl )
     #soup = BeautifulSoup(page)
     soup = BeautifulSoup(page, "html.parser") # to get rid of warning triggered by above line
     tables = soup.findAll("table")[1:]
@@ -677,33 +1829,79 @@ def download_current_rochester_info():
                 pass
     return C_ROCHESTER_DICT
 
-def download_rochester_info():
+def download_rochester_info( ttl=None ):
     print 'Downloading Rochester pages ...'
     global ROCHESTER_DICT
-    C_ROCHESTER_DICT = download_current_rochester_info()
-    H_ROCHESTER_DICT = download_historical_rochester_info()
+    C_ROCHESTER_DICT = download_current_rochester_info( ttl=ttl )
+    H_ROCHESTER_DICT = download_historical_rochester_info( ttl=ttl )
     ROCHESTER_DICT = {}
     ROCHESTER_DICT.update( C_ROCHESTER_DICT )
     ROCHESTER_DICT.update( H_ROCHESTER_DICT )
     return
 
-def get_SN_info_rochester( name=None, coords=None, interactive=0 ):
+def refresh_rochester_info( cachefile=rochester_cache.DEFAULT_CACHE ):
+    """
+    Downloads the Rochester pages into ROCHESTER_DICT and saves them to the on-disk
+     cache (see rochester_cache.py), whatever the age of the saved copy.
+    """
+    download_rochester_info( ttl=0 )
+    rochester_cache.save( ROCHESTER_DICT, cachefile )
+
+def load_rochester_info( ttl=rochester_cache.TTL, cachefile=rochester_cache.DEFAULT_CACHE ):
+    """
+    Makes sure ROCHESTER_DICT is loaded: from memory if we have it already this session,
+     else from the on-disk cache if that is younger than <ttl> seconds, else from the web.
+    If the download fails, falls back on a saved copy of any age.
+    """
+    global ROCHESTER_DICT
+    if ROCHESTER_DICT != None:
+        return
+    # several resolver threads may ask at once; only one of them should download
+    with _ROCHESTER_LOCK:
+        if ROCHESTER_DICT == None:
+            _load_rochester_info( ttl, cachefile )
+
+def _load_rochester_info( ttl, cachefile ):
+    global ROCHESTER_DICT
+    d, fetched = rochester_cache.load( cachefile, ttl )
+    if d != None:
+        ROCHESTER_DICT = d
+        return
+    try:
+        refresh_rochester_info( cachefile )
+    except IOError, e:
+        d, fetched = rochester_cache.load( cachefile, ttl=None )
+        if d == None:
+            raise
+        print 'Could not download the Rochester pages (%s); using the copy from %s.' %(e, time.ctime(fetched))
+        ROCHESTER_DICT = d
+
+def rochester_sky_index():
+    """
+    Returns (names, SkyIndex) for the objects in ROCHESTER_DICT, building the index
+     only when ROCHESTER_DICT has been (re)loaded.
+    """
+    global _ROCHESTER_INDEX
+    if (_ROCHESTER_INDEX == None) or (_ROCHESTER_INDEX[0] is not ROCHESTER_DICT):
+        keys = ROCHESTER_DICT.keys()
+        index = SkyIndex( [ROCHESTER_DICT[k][1] for k in keys], [ROCHESTER_DICT[k][2] for k in keys] )
+        _ROCHESTER_INDEX = (ROCHESTER_DICT, keys, index)
+    return _ROCHESTER_INDEX[1], _ROCHESTER_INDEX[2]
+
+def get_SN_info_rochester( name=None, coords=None, interactive=0, host_info=True ):
     """
     Queries dictionary built from rochester SN page for info on objects.
-    If ROCHESTER_DICT has not yet been built this session, will query the page and
-     parse it (takes ~10s).
+    If ROCHESTER_DICT has not yet been built this session, will load it from the on-disk
+     cache, or query the page and parse it (takes ~10s) if the cache is out of date.
+     Use refresh_rochester_info() to force a fresh download.
     Must include either name or coords (prefers name over coords).
     If interactive >0 , will ask for confirmation if the code is not sure.
+    If host_info == False, will not go on to query simbad about the host.
     """
     if (name == None) and (coords == None):
         raise Exception('Requires name or coords arguments!')
-    global ROCHESTER_DICT
-    # if we've downloaded it already this session, don't do it again!
-    try:
-        _ = type(ROCHESTER_DICT)
-    except NameError:
-        # need to build the ROCHESTER DICT
-        download_rochester_info()
+    # if we've loaded it already this session, don't do it again!
+    load_rochester_info()
     
     outd = {}
     if name != None:
@@ -716,19 +1914,16 @@ def get_SN_info_rochester( name=None, coords=None, interactive=0 ):
         # see if we have a source that matches these coordinates
         ra = parse_ra( coords[0] )
         dec = parse_dec( coords[1] )
-        keys = ROCHESTER_DICT.keys()
-        diffs = [ (ROCHESTER_DICT[k][1]-ra)**2 + (ROCHESTER_DICT[k][2]-dec)**2 for k in keys ]
-        i = np.argmin(diffs)
-        if diffs[i] == 0.0:
-            name = keys[i]
+        keys, index = rochester_sky_index()
+        rows, seps = index.query_nearest( ra, dec, k=max(interactive, 1) )
+        if len(rows) and (seps[0] == 0.0):
+            name = keys[rows[0]]
             host, ra, dec, sn_type, ref_link, date, discoverer = ROCHESTER_DICT[ name ]
         elif interactive:
             gotit = False
-            dd = zip( diffs, keys )
-            dd.sort()
             print 'Matching against Rochester SN page objects:'
-            for attempt in range(interactive):
-                name = dd[attempt][1]
+            for i in rows[:interactive]:
+                name = keys[i]
                 print name
                 print ' host=',ROCHESTER_DICT[ name ][0]
                 print ' ra=',ROCHESTER_DICT[ name ][1]
@@ -748,7 +1943,7 @@ def get_SN_info_rochester( name=None, coords=None, interactive=0 ):
     outd['Name'] = name
     outd['HostName'] = host
     # pull any simbad info you can about the host if it has a name
-    if host != 'Anon.':
+    if host_info and (host != 'Anon.'):
         hostd = get_host_info_simbad( host )
         outd.update( hostd )
     outd['RA'] = ra
@@ -759,12 +1954,13 @@ def get_SN_info_rochester( name=None, coords=None, interactive=0 ):
     outd['Discoverer'] = discoverer
     return outd
 
-def get_SN_info_TNS( name=None, coords=None, interactive=0 ):
+def get_SN_info_TNS( name=None, coords=None, interactive=0, host_info=True ):
     """
     Given a name and/or coordinates, finds the best match from the TNS page.
     
     If interactive is an integer (n) greater than 0, will interactively ask the user to 
      verify the first n results to choose the correct one.
+    If host_info == False, will not go on to query simbad about the host.
 
     Raises an error in the case of no good matches, and returns a dictionary
      of values if a match is made.
@@ -775,8 +1971,8 @@ def get_SN_info_TNS( name=None, coords=None, interactive=0 ):
         try:
             # strip it of any prefixes
             tns_name = re.search('\d{4}[a-zA-Z]+',name).group()
-            uri = 'https://wis-tns.weizmann.ac.il/object/'+tns_name
-            page = urlopen( uri ).read()
+            uri = TNS_URI+'/object/'+tns_name
+            page = http_cache.fetch( uri, 'tns' )
             #soup = BeautifulSoup(page)
             soup = BeautifulSoup(page, "html.parser") # to get rid of warning triggered by above line
             found = True
@@ -787,8 +1983,8 @@ def get_SN_info_TNS( name=None, coords=None, interactive=0 ):
         # see if we have a source that matches these coordinates
         ra = parse_ra( coords[0] )
         dec = parse_dec( coords[1] )
-        uri = 'https://wis-tns.weizmann.ac.il//search?&ra=%.5f&decl=%.5f&radius=1&coords_unit=arcmin&format=csv'%(ra,dec)
-        lines = urlopen(uri).readlines()
+        uri = TNS_URI+'//search?&ra=%.5f&decl=%.5f&radius=1&coords_unit=arcmin&format=csv'%(ra,dec)
+        lines = http_cache.fetch( uri, 'tns', TNS_NO_RESULTS ).splitlines( True )
         if len(lines) == 1:
             # means no sources found
             return {}
@@ -801,13 +1997,14 @@ def get_SN_info_TNS( name=None, coords=None, interactive=0 ):
             for i,v in enumerate(l.split('","')):
                 results_dict[header[i]].append(v)
         # sort by distance from queried point
-        diffs = [ (parse_ra(results_dict['RA'][i])-ra)**2 + (parse_dec(results_dict['DEC'][i])-dec)**2 for i in range(len(results_dict['Name'])) ]
-        i = np.argmin(diffs)
-        if diffs[i] == 0.0:
+        seps = angular_separation( ra, dec, parse_ra_array(results_dict['RA']), parse_dec_array(results_dict['DEC']) )
+        order = np.argsort( seps )
+        i = order[0]
+        if seps[i] == 0.0:
             name = results_dict['Name'][i]
             tns_name = re.search('\d{4}[a-zA-Z]+',name).group()
         else:
-            for i in range(min(interactive,len(results_dict['Name']))):
+            for i in order[:interactive]:
                 print 'Matching against TNS objects by coordinates:'
                 print results_dict['Name'][i]
                 print ' host=',results_dict[ 'Host Name' ][i]
@@ -823,8 +2020,8 @@ def get_SN_info_TNS( name=None, coords=None, interactive=0 ):
                     break
             if not found:
                 return {}
-        uri = 'https://wis-tns.weizmann.ac.il/object/'+tns_name
-        page = urlopen( uri ).read()
+        uri = TNS_URI+'/object/'+tns_name
+        page = http_cache.fetch( uri, 'tns' )
         #soup = BeautifulSoup(page)
         soup = BeautifulSoup(page, "html.parser") # to get rid of warning triggered by above line
     elif not found:
@@ -862,12 +2059,165 @@ def get_SN_info_TNS( name=None, coords=None, interactive=0 ):
     outd['Name'] = name
 
     # pull any simbad info you can about the host if it has a name
-    if outd.get('HostName') not in [None,'Anon.']:
+    if host_info and (outd.get('HostName') not in [None,'Anon.']):
         hostd = get_host_info_simbad( outd.get('HostName') )
         outd.update( hostd )
     outd['TypeReference'] = 'TNS'
     return outd
 
+def _host_name( info ):
+    """
+    Returns the host galaxy named in a resolver's result, if it is worth asking simbad about.
+    """
+    host = info.get('HostName')
+    if host in [None, '', 'Anon.']:
+        return None
+    return host
+
+class _Resolver( object ):
+    """
+    Runs the SN info queries for one object on a pool of threads, starting the simbad
+     query for a host galaxy as soon as any of them names one.
+    """
+    def __init__( self, nthreads=8, timeouts=None ):
+        self.pool = ThreadPool( nthreads )
+        self.timeouts = dict( RESOLVER_TIMEOUTS )
+        self.timeouts.update( timeouts or {} )
+        self.lock = threading.Lock()
+        self.hosts = {}  # host name: AsyncResult of its simbad query
+
+    def close( self ):
+        # anything still running is left to finish (or time out) on its own
+        self.pool.close()
+
+    def _run( self, func, args, kwargs ):
+        info = func( *args, **kwargs )
+        if info:
+            self.host_query( _host_name( info ) )
+        return info
+
+    def submit( self, func, *args, **kwargs ):
+        return self.pool.apply_async( self._run, (func, args, kwargs) )
+
+    def host_query( self, host ):
+        if host == None:
+            return None
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = self.pool.apply_async( get_host_info_simbad, (host,) )
+            return self.hosts[host]
+
+    def get( self, result, source, what ):
+        """
+        Waits (up to the timeout for <source>) for a query; returns {} if it failed or timed out.
+        """
+        if result == None:
+            return {}
+        try:
+            return result.get( self.timeouts[source] ) or {}
+        except TimeoutError:
+            print 'Gave up on %s after %.0f s.' %(what, self.timeouts[source])
+        except Exception, e:
+            print '%s failed: %s' %(what, e)
+        return {}
+
+    def with_host( self, info, what ):
+        """
+        Adds the simbad info on the host galaxy to <info>, as the single-source queries do.
+        """
+        host = _host_name( info )
+        if host != None:
+            info.update( self.get( self.host_query( host ), 'simbad', 'simbad query for host %s' %host ) )
+        return info
+
+def resolve_object( objname, coords=None, interactive=5, nthreads=8, timeouts=None ):
+    """
+    Gathers what TNS, the Rochester page and simbad know about an object, querying
+     them all at once (see RESOLVER_TIMEOUTS for how long each is given).
+    <coords> = (ra, dec), if given, is used when no source knows the name (or objname
+     is None), asking
+     the user to choose among up to <interactive> nearby objects.
+    Precedence is TNS by name, then Rochester by name (as given, then lowercase
+     without spaces), then TNS and Rochester by coordinates; simbad's answers are
+     added on top of whichever of those wins.
+    Returns a dictionary (empty if nothing was found).
+    """
+    r = _Resolver( nthreads, timeouts )
+    try:
+        tns, roch, roch2, simbad = None, None, None, None
+        if objname != None:
+            tns = r.submit( get_SN_info_TNS, objname, host_info=False )
+            roch = r.submit( get_SN_info_rochester, objname, host_info=False )
+            roch2 = r.submit( get_SN_info_rochester, objname.lower().replace(' ',''), host_info=False )
+            simbad = r.submit( get_SN_info_simbad, objname, host_info=False )
+        # non-interactively, this only returns an exact match, but it gets the TNS
+        #  search results into the http cache for the interactive query below
+        tns_coords = r.submit( get_SN_info_TNS, coords=coords, host_info=False ) if coords != None else None
+
+        info = r.get( tns, 'tns', 'TNS query for %s' %objname )
+        if not info:
+            info = r.get( roch, 'rochester', 'Rochester query for %s' %objname )
+        if not info:
+            info = r.get( roch2, 'rochester', 'Rochester query for %s' %objname )
+        if (not info) and (coords != None):
+            info = r.get( tns_coords, 'tns', 'TNS query by coordinates' )
+            if (not info) and interactive:
+                info = get_SN_info_TNS( coords=coords, interactive=interactive, host_info=False )
+            if not info:
+                info = get_SN_info_rochester( coords=coords, interactive=interactive, host_info=False )
+        r.with_host( info, objname )
+        info.update( r.with_host( r.get( simbad, 'simbad', 'simbad query for %s' %objname ), objname ) )
+    finally:
+        r.close()
+    return info
+
+def resolve_objects( targets, nworkers=8, nthreads=4, timeouts=None ):
+    """
+    Resolves a whole batch of objects at once (non-interactively).
+    Each target is an object name, or a tuple of (name, (ra, dec)).
+    Duplicate targets are only looked up once, up to <nworkers> objects are
+     resolved at a time (each with <nthreads> threads; see resolve_object), and
+     the requests themselves are held to http_cache.RATE_LIMITS.
+
+    Returns (results, failures): dictionaries keyed by target, of the info found
+     and of why nothing was found.  Coordinates given as a list are keyed as a tuple.
+
+    To test against local stand-ins for TNS, simbad and Rochester, point TNS_URI,
+     SIMBAD_URI and ROCHESTER_URI at them (and turn off http_cache, or point it at
+     a scratch file).
+     > results, failures = resolve_objects( ['SN 2011fe', ('PSN J1234', (188.5, 12.1))] )
+    """
+    unique, seen = [], set()
+    for t in targets:
+        if not isinstance( t, basestring ):
+            name, coords = t
+            t = (name, None if coords == None else tuple( coords ))
+        if t not in seen:
+            seen.add( t )
+            unique.append( t )
+    pool = ThreadPool( nworkers )
+    try:
+        jobs = []
+        for t in unique:
+            if isinstance( t, basestring ):
+                name, coords = t, None
+            else:
+                name, coords = t
+            jobs.append( (t, pool.apply_async( resolve_object, (name, coords, 0, nthreads, timeouts) )) )
+        results, failures = {}, {}
+        for t, job in jobs:
+            try:
+                info = job.get()
+            except Exception, e:
+                failures[t] = '%s: %s' %(e.__class__.__name__, e)
+                continue
+            if info:
+                results[t] = info
+            else:
+                failures[t] = 'not found'
+    finally:
+        pool.close()
+    return results, failures
 
 def parse_photfile( f ):
     """
@@ -10,17 +10,22 @@ Any time a folder is changed, run the appropriate function:
 """
 
 import numpy as np
-import MySQLdb
-import MySQLdb.cursors
-import credentials as creds
 import re
 import os
 import pwd
 import fnmatch
 from glob import glob
+from contextlib import contextmanager
 import SNDBLib
 from SNDBLib import *
-DB = MySQLdb.connect(host=creds.host, user=creds.user, passwd=creds.passwd, db=creds.db, cursorclass=MySQLdb.cursors.DictCursor)
+import db_pool
+# connects on first use (see db_pool.py)
+DB = db_pool.lazy_connection()
+
+# radius (deg) for matching objects by coordinates; about the old (dRA^2 + dDec^2) < 10 cut
+CONE_RADIUS = 3.16
+# separation (deg) below which a lone coordinate match is taken without asking
+SAME_OBJECT_RADIUS = 5./3600
 
 #################################################################
 # helper functions
@@ -39,6 +44,199 @@ def print_sql( sql, vals=None ):
         s = sql %tuple( map(str, vals) )
         print s
 
+@contextmanager
+def writing( cursor=None ):
+    """
+    Yields a cursor to write with: <cursor> itself if given, leaving the commit to
+     whoever opened its transaction, or else a cursor in a transaction of its own
+     that is committed at the end of the with block (or rolled back if it raises).
+    """
+    if cursor != None:
+        yield cursor
+    else:
+        with DB.transaction() as c:
+            yield c
+
+class _NewRow( object ):
+    """
+    Placeholder for the id of a row that PendingWrites has not inserted yet.
+    """
+    def __init__( self, index, table ):
+        self.index = index
+        self.table = table
+
+    def __str__( self ):
+        return '<new %s row>' %self.table
+    __repr__ = __str__
+
+class PendingWrites( object ):
+    """
+    Stands in for a cursor while a whole folder is gathered: statements are queued
+     instead of run, so no transaction is held open through the prompts, web lookups
+     and SNID runs.  lastrowid is a placeholder (_NewRow) that later statements can
+     use as a value.  New objects (by name) and spectral runs (by date and observer)
+     are kept in .objects and .runs, so later files can find them before they exist.
+    commit() then runs everything in one short transaction, swapping in the real ids.
+    """
+    def __init__( self ):
+        self.statements = []
+        self.lastrowid = None
+        self.objects = {}
+        self.runs = {}
+
+    def execute( self, sql, vals=None ):
+        vals = list( vals or [] )
+        self.statements.append( (sql, vals) )
+        m = re.match( '\s*INSERT INTO (\w+)', sql, re.I )
+        self.lastrowid = _NewRow( len(self.statements)-1, m and m.group(1) )
+
+    def commit( self ):
+        """
+        Writes everything queued in a single transaction.  Returns the number of statements run.
+        """
+        ids = {}
+        with DB.transaction() as c:
+            for i, (sql, vals) in enumerate( self.statements ):
+                vals = [ids[v.index] if isinstance( v, _NewRow ) else v for v in vals]
+                c.execute( sql, vals )
+                ids[i] = c.lastrowid
+        return len( self.statements )
+
+def cone_search_sql( ra, dec, radius ):
+    """
+    Builds the SQL (and values) to pull the candidate objects within <radius> degrees of
+     (ra, dec): a Decl band (which uses the index made by create_cone_index) plus an RA
+     window widened by 1/cos(Dec) and wrapped across RA=0/360.  Near the poles the RA
+     window is dropped.  Returns (sql, vals); the band is a superset of the cone.
+    """
+    sql = 'SELECT ObjID, ObjName, RA, Decl FROM objects WHERE (Decl BETWEEN %s AND %s)'
+    vals = [dec - radius, dec + radius]
+    if (dec + radius < 90.) and (dec - radius > -90.):
+        halfwidth = np.degrees( np.arcsin( np.sin(np.radians(radius)) / np.cos(np.radians(dec)) ) )
+        lo, hi = ra - halfwidth, ra + halfwidth
+        if lo < 0.:
+            sql += ' AND ((RA >= %s) OR (RA <= %s))'
+            vals.extend( [lo + 360., hi] )
+        elif hi >= 360.:
+            sql += ' AND ((RA >= %s) OR (RA <= %s))'
+            vals.extend( [lo, hi - 360.] )
+        else:
+            sql += ' AND (RA BETWEEN %s AND %s)'
+            vals.extend( [lo, hi] )
+    return sql + ';', vals
+
+def cone_search( ra, dec, radius=CONE_RADIUS, limit=5, cursor=None, paramstyle='format' ):
+    """
+    Finds the objects in the DB within <radius> degrees of (ra, dec), closest first.
+    Only the rows selected by cone_search_sql are read; exact angular separations are
+     computed here.
+    Returns a list of up to <limit> dicts with ObjID, ObjName, RA, Decl and dist (degrees).
+
+    Can be pointed at any other DB-API cursor holding an objects table (e.g. an sqlite3
+     copy for testing; use paramstyle='qmark' for that).
+    """
+    sql, vals = cone_search_sql( ra, dec, radius )
+    if paramstyle == 'qmark':
+        sql = sql.replace( '%s', '?' )
+    if cursor == None:
+        cursor = DB.cursor()
+    cursor.execute( sql, vals )
+    rows = [ r if isinstance(r, dict) else dict( zip(['ObjID','ObjName','RA','Decl'], r) ) for r in cursor.fetchall() ]
+    if not rows:
+        return []
+    seps = angular_separation( ra, dec, np.array( [r['RA'] for r in rows], dtype=float ),
+                               np.array( [r['Decl'] for r in rows], dtype=float ) )
+    out = []
+    for i in np.argsort( seps, kind='mergesort' ):
+        if seps[i] <= radius:
+            rows[i]['dist'] = seps[i]
+            out.append( rows[i] )
+    return out[:limit]
+
+def create_cone_index():
+    """
+    Adds the index on objects.Decl that cone_search relies on.  Only needs to be run once.
+    """
+    c = DB.cursor()
+    sql = 'CREATE INDEX objects_Decl ON objects (Decl);'
+    print_sql( sql )
+    c.execute( sql )
+    DB.commit()
+    c.close()
+
+def db_objname( objname ):
+    """
+    Massages an object name in folder format (e.g. sn2016abc, psn...) into the
+     format used in the DB (SN 2016abc, PSN...).  Other names are returned as-is.
+    """
+    if re.search( '[sS][nN]\d{4}.+', objname ):
+        # massage folder formats into the normal SN format in the DB
+        objname = objname.replace('sn','SN ')  #together these two formats handle SN and PSN variants
+        objname = objname.replace('pSN','PSN')
+        if re.search( '\d{4}[a-zA-Z]$', objname ):
+            # this capitalizes the letter if there's only one (i.e. 2016A); leaves them
+            #  lowercase if there's 2+ (i.e. (2016ab)
+            objname = objname.upper()
+    return objname
+
+def crossmatch_objects( entries, radius=CONE_RADIUS, k=5, cursor=None, paramstyle='format' ):
+    """
+    Matches a whole batch of (name, ra, dec) tuples against the objects table at once
+     (any of name, ra, dec may be None).  Makes one query for all the names and one
+     for all the candidate coordinates, then matches everything in memory.
+
+    Returns a dictionary with:
+     'exact': {i: ObjID} for entries whose name is in the DB (case insensitive, as MySQL compares),
+     'candidates': {i: [(ObjID, ObjName, separation in deg), ...]} for the rest, with up to
+                   <k> objects within <radius> degrees, closest first,
+     'unmatched': [i, ...] for entries with neither.
+    i indexes into entries.
+
+    Can be pointed at any other DB-API cursor holding an objects table (e.g. an sqlite3
+     copy for testing; use paramstyle='qmark' for that).
+    """
+    if cursor == None:
+        cursor = DB.cursor()
+    todict = lambda r, cols: r if isinstance(r, dict) else dict( zip(cols, r) )
+    fix = (lambda sql: sql.replace('%s','?')) if paramstyle == 'qmark' else (lambda sql: sql)
+    out = {'exact':{}, 'candidates':{}, 'unmatched':[]}
+
+    names = list( set( [e[0] for e in entries if e[0] != None] ) )
+    byname = {}
+    if names:
+        sql = 'SELECT ObjID, ObjName FROM objects WHERE ObjName IN (%s);' %(', '.join( ['%s']*len(names) ))
+        cursor.execute( fix(sql), names )
+        for r in cursor.fetchall():
+            r = todict( r, ['ObjID','ObjName'] )
+            byname.setdefault( r['ObjName'].lower(), r['ObjID'] )
+
+    rest = []
+    for i, (name, ra, dec) in enumerate( entries ):
+        if (name != None) and (name.lower() in byname):
+            out['exact'][i] = byname[name.lower()]
+        elif (ra != None) and (dec != None):
+            rest.append( i )
+        else:
+            out['unmatched'].append( i )
+    if not rest:
+        return out
+
+    # one Decl band covering the whole batch
+    decs = [entries[i][2] for i in rest]
+    sql = 'SELECT ObjID, ObjName, RA, Decl FROM objects WHERE (Decl BETWEEN %s AND %s);'
+    cursor.execute( fix(sql), [min(decs) - radius, max(decs) + radius] )
+    objs = [ todict( r, ['ObjID','ObjName','RA','Decl'] ) for r in cursor.fetchall() ]
+    index = SkyIndex( [o['RA'] for o in objs], [o['Decl'] for o in objs] )
+    for i in rest:
+        rows, seps = index.query_nearest( entries[i][1], entries[i][2], k=k )
+        cands = [ (objs[j]['ObjID'], objs[j]['ObjName'], sep) for j,sep in zip(rows, seps) if sep <= radius ]
+        if cands:
+            out['candidates'][i] = cands
+        else:
+            out['unmatched'].append( i )
+    out['unmatched'].sort()
+    return out
+
 def query_DB_object( objname=None, fitspath=None ):
     """
     Queries DB for an object.  If given fitspath (path to a fitsfile) will attempt
@@ -55,26 +253,28 @@ def query_DB_object( objname=None, fitspath=None ):
         # search by coordinate
         info = get_info_spec_fitsfile( fitspath )
         ra,dec = info['ra_d'],info['dec_d']
-        sqlfind = 'SELECT ObjID,ObjName, (POW(RA - %s, 2) + POW(Decl - %s, 2)) AS dist FROM objects '+\
-                  'HAVING dist < 10.0 ORDER BY dist LIMIT 5;' 
-        vals = [ ra, dec ]
-        c = DB.cursor()
-        c.execute( sqlfind, vals )
-        r = c.fetchmany( 5 )
+        if (ra == None) or (dec == None):
+            # no coordinates in the header to search with
+            return None
+        r = cone_search( ra, dec, limit=5 )
         print 'Attempting to match against objects in the DB:'
         for rr in r:
-            inn = raw_input( '\nUse %s? [y/n](n):\n' %rr['ObjName'] )
+            inn = raw_input( '\nUse %s (%.1f arcsec away)? [y/n](n):\n' %(rr['ObjName'], rr['dist']*3600.) )
             if 'y' in inn.lower():
                 res = rr
                 break
     if res:
         return res['ObjID'] 
     
-def handle_object( objname, fitspath=None ):
+def handle_object( objname, fitspath=None, cursor=None ):
     """
     does the best it can to add object info based only upon a name. objname should be as you want it to be in the SNDB.
     If given a path to a fitsfile, will check for object info based upon coordinates and may interactively ask for confirmation.
+    If given a cursor, the insert goes into its transaction and is not committed here.
     """
+    if isinstance( cursor, PendingWrites ) and (objname in cursor.objects):
+        # already queued for insertion
+        return cursor.objects[objname]
     # see if object already exists
     res = query_DB_object( objname, fitspath )
     if res:
@@ -85,22 +285,14 @@ def handle_object( objname, fitspath=None ):
         sqlinsert = "INSERT INTO objects (ObjName, RA, Decl, Type, TypeReference, Redshift_SN, HostName, HostType, Redshift_Gal, Notes, DiscBy, DiscDate) "+\
                                  "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, DATE(%s));"
         vals = [objname]
-        info = get_SN_info_TNS( objname )
-        if not info:
-            # parse rochester to get info. all characters are lowercase in ROCHESTER
-            info = get_SN_info_rochester( objname )
-        if not info:
-            # try with a different spacing scheme
-            info = get_SN_info_rochester( objname.lower().replace(' ','') )
-        if (not info) and (fitspath != None):
-            # try with coordinate matching pulled from fitsfile
+        coords = None
+        if fitspath != None:
+            # allow coordinate matching pulled from fitsfile
             res  = get_info_spec_fitsfile( fitspath )
-            ra,dec = res['ra_d'],res['dec_d']
-            info = get_SN_info_TNS( coords=(ra,dec), interactive=5 )
-            if not info:
-                info = get_SN_info_rochester( coords=(ra,dec), interactive=5 )
-        # parse simbad to attempt to find more info. simbad understands a variety of name formats
-        info.update( get_SN_info_simbad( objname ) )
+            coords = (res['ra_d'],res['dec_d'])
+        # query TNS, rochester and simbad (which understands a variety of name formats) all at once;
+        #  TNS wins over rochester, and simbad adds whatever else it knows
+        info = resolve_object( objname, coords=coords, interactive=5 )
         # if neither method got us any where, raise an error
         if not info:
             raise Exception( 'Cannot find any info on this object : %s'%objname )
@@ -114,19 +306,17 @@ def handle_object( objname, fitspath=None ):
         vals.append( date )
         # now go ahead and put it in
         print_sql( sqlinsert, vals )
-        c = DB.cursor()
-        c.execute( sqlinsert, vals )
-        DB.commit()
-        # now grab the ObjID from this new entry
-        sqlfind = 'SELECT ObjID FROM objects WHERE ObjName = %s;'
-        c.execute( sqlfind, [objname] )
-        res = c.fetchone()
-        c.close()
-        return res['ObjID']
+        with writing( cursor ) as c:
+            c.execute( sqlinsert, vals )
+            objid = c.lastrowid
+        if isinstance( cursor, PendingWrites ):
+            cursor.objects[objname] = objid
+        return objid
 
-def handle_spectralrun( fitsfile, objname, runcode=None, interactive=True ):
+def handle_spectralrun( fitsfile, objname, runcode=None, interactive=True, cursor=None ):
     """
     fitsfile should be absolute path. objname should be as you want it in the SNDB.
+    If given a cursor, the changes go into its transaction and are not committed here.
     """
     # parse the input files to find the runinfo
     info = get_info_spec_fitsfile( fitsfile )
@@ -136,6 +326,13 @@ def handle_spectralrun( fitsfile, objname, runcode=None, interactive=True ):
     except AttributeError:
         datestr = '%d-%d-%d' %(info['date2'].year, info['date2'].month, info['date2'].day)    
     observer = info['observer']
+    pending = isinstance( cursor, PendingWrites )
+    if pending and ((datestr, observer) in cursor.runs):
+        # this run already has a write queued; add to its Targets there
+        runid, vals, i = cursor.runs[(datestr, observer)]
+        if objname not in vals[i]:
+            vals[i] += ' | ' + objname
+        return runid
     sqlfind = 'SELECT RunID,Targets FROM spectralruns WHERE (UT_Date = Date(%s)) AND (Observer = %s);'
     c = DB.cursor()
     c.execute( sqlfind, [datestr, observer] )
@@ -146,9 +343,12 @@ def handle_spectralrun( fitsfile, objname, runcode=None, interactive=True ):
             # append this object name onto the end of the objects observed and return RunID
             sqlupdate = "UPDATE spectralruns SET Targets = %s WHERE (RunID = %s);"
             newtargets = res['Targets'] + ' | ' + objname
-            print_sql( sqlupdate, [newtargets, res['RunID']] )
-            c.execute( sqlupdate, [newtargets, res['RunID']] )
-            DB.commit()
+            vals = [newtargets, res['RunID']]
+            print_sql( sqlupdate, vals )
+            with writing( cursor ) as wc:
+                wc.execute( sqlupdate, vals )
+            if pending:
+                cursor.runs[(datestr, observer)] = (res['RunID'], cursor.statements[-1][1], 0)
         return res['RunID']
     else:
         # need to parse the input files to define the spectral run
@@ -178,37 +378,32 @@ def handle_spectralrun( fitsfile, objname, runcode=None, interactive=True ):
         else:
             vals.append( None )
         print_sql( sqlinsert, vals )
-        c.execute( sqlinsert, vals )
-        DB.commit()
-        # now grab the RunID from this new entry
-        c.execute( sqlfind, [datestr, observer] )
-        res = c.fetchone()
         c.close()
-        return res['RunID']
+        with writing( cursor ) as c:
+            c.execute( sqlinsert, vals )
+            runid = c.lastrowid
+        if pending:
+            cursor.runs[(datestr, observer)] = (runid, cursor.statements[-1][1], 2)
+        return runid
         
-def handle_spectrum( flmfile, fitsfile, objname, objid=None, runid=None, just_ask=False ):
+def handle_spectrum( flmfile, fitsfile, objname, objid=None, runid=None, just_ask=False, cursor=None ):
     """
     flmfile and fitsfile should be absolute paths, objname should be the name of the 
      object. can be in folder format instead of DB format.
     Can optionally include objid or runid (for objects or spectralruns tables) to override the
       code's default guesses.
     If just_ask == True, will simply query the DB to see if file already in DB.
+    If given a cursor, the inserts (including any new object or spectral run) go into its
+     transaction and are not committed here.
     """
-    # test to see whether the flmfile is readable
+    # test to see whether the flmfile is readable (this also loads it for get_info_spec_flmfile below)
     try:
-        _ = np.loadtxt(flmfile)
+        _ = SNDBLib.load_spectrum( flmfile ).data
     except:
         raise Exception('ascii .flm file not readable; formatted wrong?')
 
     # parse the objname if it's not in DB format
-    if re.search( '[sS][nN]\d{4}.+', objname ):
-        # massage folder formats into the normal SN format in the DB
-        objname = objname.replace('sn','SN ')  #together these two formats handle SN and PSN variants
-        objname = objname.replace('pSN','PSN')
-        if re.search( '\d{4}[a-zA-Z]$', objname ):
-            # this capitalizes the letter if there's only one (i.e. 2016A); leaves them
-            #  lowercase if there's 2+ (i.e. (2016ab)
-            objname = objname.upper()
+    objname = db_objname( objname )
     # first see if this file is already in the database
     sqlfind = 'SELECT SpecID FROM spectra WHERE (Filename = %s) and (Filepath = %s);'
     fpath, fname = os.path.split( flmfile )
@@ -228,9 +423,9 @@ def handle_spectrum( flmfile, fitsfile, objname, objid=None, runid=None, just_as
                                  "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s );"
         # handle the object and spectralrun
         if objid == None:
-            objid = handle_object( objname, fitsfile )
+            objid = handle_object( objname, fitsfile, cursor=cursor )
         if runid == None:
-            runid = handle_spectralrun( fitsfile, objname )
+            runid = handle_spectralrun( fitsfile, objname, cursor=cursor )
         vals = [objid, runid, fname, fpath]
         # pull info from fitsfile 
         info = get_info_spec_fitsfile( fitsfile )
@@ -263,18 +458,16 @@ def handle_spectrum( flmfile, fitsfile, objname, objid=None, runid=None, just_as
             vals.append( None )
         # actually do the insert
         print_sql( sqlinsert, vals )
-        c.execute( sqlinsert, vals )
-        DB.commit()
-        # now grab the SpecID from this new entry
-        c.execute( sqlfind, [fname, fpath] )
-        res = c.fetchone()
         c.close()
-        return res['SpecID'], True
+        with writing( cursor ) as c:
+            c.execute( sqlinsert, vals )
+            return c.lastrowid, True
 
-def handle_lightcurve( photfile, objname ):
+def handle_lightcurve( photfile, objname, cursor=None ):
     """
     photfile should be absolute path to new lightcurve file. objname should be the name of the 
      object. can be in folder format instead of DB format.
+    If given a cursor, the changes go into its transaction and are not committed here.
     """
     # parse the objname if it's not in DB format
     if re.search( '[sS][nN]\d{4}.+', objname ):
@@ -290,16 +483,17 @@ def handle_lightcurve( photfile, objname ):
     c = DB.cursor()
     c.execute( sqlfind, [fname, fpath] )
     res = c.fetchone()
-    photid = res.get('PhotID') # this will be None if an entry doesn't yet exist
+    photid = (res or {}).get('PhotID') # this will be None if an entry doesn't yet exist
     # see if the file is public
     if 'public' in fname:
         public = 1
     else:
         public = 0
+    c.close()
     # get the object id
-    objid = handle_object( objname )
+    objid = handle_object( objname, cursor=cursor )
     # pull info from photfile
-    firstobs, lastobs, filters, telescopes, npoints = parse_photfile( f )
+    firstobs, lastobs, filters, telescopes, npoints = parse_photfile( photfile )
     firstobs = '%d-%d-%d'%(firstobs[0],firstobs[1],firstobs[2])
     lastobs = '%d-%d-%d'%(lastobs[0],lastobs[1],lastobs[2])
     # now actually put it in
@@ -308,19 +502,16 @@ def handle_lightcurve( photfile, objname ):
     sqlupdate = "UPDATE photometry SET ObjId = %s, Filename = %s, Filepath = %s, Filters = %s, Telescopes = %s, FirstObs = Date(%s), LastObs = Date(%s), NPoints = %s, Public = %s "+\
                 "WHERE (PhotID = %s);"
     vals = [objid, fname, fpath, filters, telescopes, firstobs, lastobs, npoints, public]
-    if photid != None:
-        vals.append( photid )
-        print_sql( sqlupdate, vals )
-        c.execute( sqlupdate, vals )
-    else:
-        print_sql( sqlinsert, vals )
-        c.execute( sqlinsert, vals )
-    DB.commit()
-    # now grab the PhotID from this new/updated entry
-    c.execute( sqlfind, [fname, fpath] )
-    res = c.fetchone()
-    c.close()
-    return res['PhotID']
+    with writing( cursor ) as c:
+        if photid != None:
+            vals.append( photid )
+            print_sql( sqlupdate, vals )
+            c.execute( sqlupdate, vals )
+        else:
+            print_sql( sqlinsert, vals )
+            c.execute( sqlinsert, vals )
+            photid = c.lastrowid
+    return photid
 
 def move_this_file( f, location ):
     # don't bother if file already exists in destination folder
@@ -404,6 +595,45 @@ def move_files( location='./', out_root='/media/raid0/Data/spectra/', add2db=Tru
 #################################################################
 # main functions
 #################################################################
+def import_spectrum_pair( flm, fit, interactive=True, objid=None, cursor=None ):
+    """
+    Import a single spectrum, given the paths to the .flm file and its matching fitsfile.
+    If objid is given, it is used as the default ObjID instead of looking the object up.
+    If given a cursor, everything is written in its transaction (see handle_spectrum).
+    Returns the SpecID (a placeholder if the cursor is a PendingWrites), or None if
+     the spectrum could not be imported.
+    """
+    objname = os.path.split(os.path.split( flm )[0])[1]
+    # test to see if file already in DB
+    specid,inserted = handle_spectrum( flm, fit, objname, just_ask=True )
+    if specid != None:
+        # already in DB
+        print flm,'already in DB: specid =',specid
+        return specid
+    # if it's not in the SNDB, get info on it and import it
+    runid = None
+    if interactive:
+        print '\nWorking with',os.path.basename(flm)
+        inn = raw_input('\no: enter objID\nr: enter runID\nn: enter Object Name\n<enter>: continue with default values\n')
+        if 'o' in inn:
+            in2 = raw_input('\nEnter objID:\n')
+            objid = int(in2)
+        if 'r' in inn:
+            in2 = raw_input('\nEnter runID:\n')
+            runid = int(in2)
+        if 'n' in inn.lower():
+            objname = raw_input('\nEnter Object Name:\n')
+            if 'o' not in inn:
+                # the default objid was for the old name; look up the new one instead
+                objid = None
+    print 'Object Name:',objname
+    specid,inserted = handle_spectrum( flm, fit, objname, objid=objid, runid=runid, cursor=cursor )
+    if isinstance( specid, _NewRow ):
+        print 'Queued; it goes into the DB with the rest of the folder.'
+    elif inserted:
+        print 'Success!  SpecID =',specid
+    return specid
+
 def import_single_spectrum( path, interactive=True ):
     """
     Import a single .flm file, given the path to it.
@@ -418,71 +648,73 @@ def import_single_spectrum( path, interactive=True ):
         if not fit:
             print 'Cannot find matching fits file for',flm
             return
-        objname = os.path.split(os.path.split( flm )[0])[1]
-        # test to see if file already in DB
-        specid,inserted = handle_spectrum( flm, fit, objname, just_ask=True )
-        if specid != None:
-            # already in DB
-            print flm,'already in DB: specid =',specid
-            return
-        # if it's not in the SNDB, get info on it and import it
-        objid, runid = None,None
-        if interactive:
-            print '\nWorking with',os.path.basename(flm)
-            inn = raw_input('\no: enter objID\nr: enter runID\nn: enter Object Name\n<enter>: continue with default values\n')
-            if 'o' in inn:
-                in2 = raw_input('\nEnter objID:\n')
-                objid = int(in2)
-            if 'r' in inn:
-                in2 = raw_input('\nEnter runID:\n')
-                runid = int(in2)
-            if 'n' in inn.lower():
-                objname = raw_input('\nEnter Object Name:\n')
-        print 'Object Name:',objname
-        specid,inserted = handle_spectrum( flm, fit, objname, objid=objid, runid=runid )
-        if inserted:
-            print 'Success!  SpecID =',specid
-
+        import_spectrum_pair( flm, fit, interactive=interactive )
         
 def import_spec_from_folder( folder, interactive=True ):
     """
     Scan a folder for any flm files not in the DB, and insert them appropriately.
+    The objects for all new files are matched against the DB in one go (see
+     crossmatch_objects); only the ambiguous ones are left for the usual
+     interactive object matching.
+    All the prompts, object lookups and SNID runs for the folder are done first,
+     and then everything is written in one short transaction (see PendingWrites):
+     if any spectrum fails, none of the folder goes in.
     """
-    specs = SNDBLib.yield_all_spectra( folder )
-    for flm,fit in specs:
+    new = []
+    for flm,fit in SNDBLib.yield_all_spectra( folder ):
         if not fit:
             print 'Cannot find matching fits file for',flm
             print '  ...skipping.'
             continue
         objname = os.path.split(os.path.split( flm )[0])[1]
-        # test to see if file already in DB
         specid,inserted = handle_spectrum( flm, fit, objname, just_ask=True )
         if specid != None:
             # already in DB
             print flm,'already in DB: specid =',specid
             continue
-        objid, runid = None,None
-        if interactive:
-            print '\nWorking with',os.path.basename(flm)
-            inn = raw_input('\no: enter objID\nr: enter runID\nn: enter Object Name\n<enter>: continue\n')
-            if 'o' in inn:
-                in2 = raw_input('\nEnter objID:\n')
-                objid = int(in2)
-            if 'r' in inn:
-                in2 = raw_input('\nEnter runID:\n')
-                runid = int(in2)
-            if 'n' in inn.lower():
-                objname = raw_input('\nEnter Object Name:\n')
-        specid,inserted = handle_spectrum( flm, fit, objname, objid=objid, runid=runid )
-        if inserted:
-            print 'Success! SpecID =',specid
+        new.append( (flm, fit, objname) )
+    if not new:
+        return
+
+    # match every new spectrum to an object at once
+    entries = []
+    for flm, fit, objname in new:
+        try:
+            info = get_info_spec_fitsfile( fit )
+            ra, dec = info['ra_d'], info['dec_d']
+        except Exception:
+            ra, dec = None, None
+        entries.append( (db_objname( objname ), ra, dec) )
+    matches = crossmatch_objects( entries )
+    try:
+        pending = PendingWrites()
+        for i, (flm, fit, objname) in enumerate( new ):
+            objid = matches['exact'].get( i )
+            close = [cand for cand in matches['candidates'].get( i, [] ) if cand[2] <= SAME_OBJECT_RADIUS]
+            if (objid == None) and (len(close) == 1):
+                # a single object right on top of this one; no need to ask
+                objid = close[0][0]
+            import_spectrum_pair( flm, fit, interactive=interactive, objid=objid, cursor=pending )
+        pending.commit()
+        print '\nSuccess!  The new spectra from %s are in the DB.' %folder
+    except:
+        print '\nImport of %s failed; none of its %d new spectra were added to the DB.' %(folder, len(new))
+        raise
 
 def import_phot_from_folder( folder ):
     """
     Scan a folder for any phot (*.dat) files not in the DB, and insert them appropriately.
+    As in import_spec_from_folder, the object lookups are all done first and the
+     whole folder is then written in a single transaction.
     """
-    for f in glob( folder+'/*.dat' ):
-        photfile = f
-        objname = f.split('.')[0]
-        handle_lightcurve( photfile, objname )
+    try:
+        pending = PendingWrites()
+        for f in glob( folder+'/*.dat' ):
+            photfile = f
+            objname = f.split('.')[0]
+            handle_lightcurve( photfile, objname, cursor=pending )
+        pending.commit()
+    except:
+        print '\nImport of %s failed; none of its lightcurves were added to the DB.' %folder
+        raise
     
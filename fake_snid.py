@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+A stand-in for the snid executable, for exercising getSNID and snid_everything
+ without SNID or its templates installed.
+
+ > SNDBLib.SNID_CMD = '/path/to/fake_snid.py'
+or
+ > python snid_everything.py --snid /path/to/fake_snid.py
+
+Called like snid (fake_snid.py plot=0 inter=0 spectrum.flm), it prints output in
+ the layout parse_snid_output reads, with a type and subtype picked from a hash
+ of the spectrum's contents (so the same spectrum always gets the same answer),
+ and leaves a <spectrum>_snid.output file in the current folder as snid does.
+About one spectrum in five gets no match at all.
+Set FAKE_SNID_DELAY (s) in the environment to make each run take that long.
+Results are only cached (see snid_cache.py) with SNID_TEMPLATES pointing at some
+ folder to stand in for the templates.
+"""
+
+import os
+import sys
+import time
+import hashlib
+
+TYPES = [('Ia','Ia-norm'), ('Ia','Ia-91T'), ('Ib','Ib-norm'), ('Ic','Ic-broad'), ('II','IIP')]
+
+def main( args ):
+    flmfile = [a for a in args if '=' not in a][-1]
+    try:
+        digest = hashlib.md5( open(flmfile, 'rb').read() ).hexdigest()
+    except IOError, e:
+        print 'Error: cannot read %s (%s)' %(flmfile, e)
+        return 1
+    time.sleep( float(os.environ.get( 'FAKE_SNID_DELAY', 0 )) )
+    h = int( digest[:8], 16 )
+    out = [' SNID (fake) run on %s' %flmfile]
+    if h % 5 != 0:
+        t, st = TYPES[ h % len(TYPES) ]
+        out += [' Best type(s)',
+                ' [fraction]',
+                '  best type: %s  (fraction = 0.%02d)' %(t, h % 100),
+                ' [slope]',
+                '  best type: %s  (slope = 0.%02d)' %(t, (h/100) % 100),
+                ' Best subtype(s)',
+                ' [fraction]',
+                '  best subtype: %s %s  (fraction = 0.%02d)' %(t, st, h % 100),
+                ' [slope]',
+                '  best subtype: %s %s  (slope = 0.%02d)' %(t, st, (h/100) % 100),
+                '']
+    else:
+        out += [' No template matches found.']
+    out += [' Thank you for using SNID! Goodbye.']
+    print '\n'.join( out )
+    name = os.path.splitext( os.path.basename(flmfile) )[0]
+    open( name + '_snid.output', 'w' ).write( '\n'.join( out ) + '\n' )
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main( sys.argv[1:] ) )
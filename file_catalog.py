@@ -0,0 +1,189 @@
+"""
+A persistent on-disk catalog of the files under our data trees.
+
+Walking all of /media/raid0/Data/spectra/ with os.walk takes minutes, and
+ almost nothing changes between two scans.  This module keeps a small SQLite
+ file that records every directory (with its mtime) and every entry in it
+ (with size and mtime).  A rescan stats each known directory and only re-lists
+ the ones whose mtime has changed, so a no-change rescan of the whole archive
+ costs one stat per directory.
+
+ > cat = FileCatalog()
+ > cat.rescan( '/media/raid0/Data/spectra/' )
+ > for root, subdirs, fnames in cat.walk( '/media/raid0/Data/spectra/' ):
+ >     ...
+
+Note that adding, removing or renaming a file changes its directory's mtime,
+ but rewriting a file in place does not; use rescan( location, full=True ) to
+ force every directory to be re-listed.
+"""
+
+import os
+import stat
+import sqlite3
+
+DEFAULT_CATALOG = os.path.join( os.path.expanduser('~'), '.sndb_file_catalog.sqlite' )
+
+# kinds of entries recorded in the catalog
+FILE = 'f'
+DIR = 'd'
+DIRLINK = 'l'  # symlink to a directory: listed like os.walk does, but never descended into
+
+class FileCatalog( object ):
+    """
+    SQLite-backed catalog of directories and files.
+    All paths are stored absolute and without trailing slashes.
+    """
+    def __init__( self, dbfile=DEFAULT_CATALOG ):
+        self.dbfile = dbfile
+        self.conn = sqlite3.connect( dbfile )
+        self.conn.text_factory = str
+        self.conn.execute( 'CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL);' )
+        self.conn.execute( 'CREATE TABLE IF NOT EXISTS entries (dir TEXT, name TEXT, kind TEXT, size INTEGER, mtime REAL, '+\
+                           'PRIMARY KEY (dir, name));' )
+        self.conn.commit()
+
+    def close( self ):
+        self.conn.close()
+
+    def _under( self, column, location ):
+        """
+        Returns an SQL condition (and its values) selecting <column> equal to
+         location or anywhere below it.
+        """
+        prefix = location.rstrip('/') + '/'
+        return '(%s = ? OR substr(%s, 1, ?) = ?)' %(column, column), [location, len(prefix), prefix]
+
+    def _list_directory( self, d ):
+        """
+        Lists directory d from disk, returning a list of (name, kind, size, mtime).
+        """
+        out = []
+        for name in os.listdir( d ):
+            try:
+                st = os.lstat( os.path.join(d, name) )
+            except OSError:
+                # removed while we were looking at it
+                continue
+            if stat.S_ISDIR( st.st_mode ):
+                kind = DIR
+            elif stat.S_ISLNK( st.st_mode ) and os.path.isdir( os.path.join(d, name) ):
+                kind = DIRLINK
+            else:
+                kind = FILE
+            out.append( (name, kind, st.st_size, st.st_mtime) )
+        return out
+
+    def _forget( self, d ):
+        """
+        Removes directory d and everything below it from the catalog.
+        """
+        cond, vals = self._under( 'path', d )
+        self.conn.execute( 'DELETE FROM dirs WHERE '+cond, vals )
+        cond, vals = self._under( 'dir', d )
+        self.conn.execute( 'DELETE FROM entries WHERE '+cond, vals )
+
+    def rescan( self, location, full=False ):
+        """
+        Brings the catalog up to date for <location> and everything below it.
+        Only directories whose mtime differs from the catalog are re-listed,
+         unless full == True.
+        Returns (number of directories seen, number of directories re-listed).
+        """
+        location = os.path.abspath( location )
+        # pull everything we already know about this tree in two queries
+        cond, vals = self._under( 'path', location )
+        known_mtimes = dict( self.conn.execute( 'SELECT path, mtime FROM dirs WHERE '+cond, vals ) )
+        cond, vals = self._under( 'dir', location )
+        known_subdirs = {}
+        for d, name in self.conn.execute( 'SELECT dir, name FROM entries WHERE kind = ? AND '+cond, [DIR]+vals ):
+            known_subdirs.setdefault( d, [] ).append( name )
+
+        nseen, nchanged = 0, 0
+        stack = [location]
+        with self.conn:
+            while stack:
+                d = stack.pop()
+                try:
+                    mtime = os.stat( d ).st_mtime
+                except OSError:
+                    # directory has disappeared
+                    self._forget( d )
+                    continue
+                nseen += 1
+                if (not full) and (known_mtimes.get( d ) == mtime):
+                    stack.extend( [os.path.join(d, sd) for sd in known_subdirs.get( d, [] )] )
+                    continue
+                # this directory changed; re-list it
+                try:
+                    listing = self._list_directory( d )
+                except OSError:
+                    self._forget( d )
+                    continue
+                nchanged += 1
+                subdirs = [name for name, kind, _, _ in listing if kind == DIR]
+                for gone in set( known_subdirs.get( d, [] ) ) - set( subdirs ):
+                    self._forget( os.path.join(d, gone) )
+                self.conn.execute( 'DELETE FROM entries WHERE dir = ?;', [d] )
+                self.conn.executemany( 'INSERT INTO entries (dir, name, kind, size, mtime) VALUES (?, ?, ?, ?, ?);',
+                                       [[d]+list(l) for l in listing] )
+                self.conn.execute( 'INSERT OR REPLACE INTO dirs (path, mtime) VALUES (?, ?);', [d, mtime] )
+                stack.extend( [os.path.join(d, sd) for sd in subdirs] )
+        return nseen, nchanged
+
+    def snapshot( self, location ):
+        """
+        Reads the catalog for <location> and everything below it.
+        Returns a dictionary of {directory: (subdirs, fnames)}, with both lists sorted.
+        """
+        location = os.path.abspath( location )
+        out = {}
+        cond, vals = self._under( 'path', location )
+        for (d,) in self.conn.execute( 'SELECT path FROM dirs WHERE '+cond, vals ):
+            out[d] = ([], [])
+        cond, vals = self._under( 'dir', location )
+        for d, name, kind in self.conn.execute( 'SELECT dir, name, kind FROM entries WHERE '+cond+' ORDER BY dir, name;', vals ):
+            subdirs, fnames = out.setdefault( d, ([], []) )
+            if kind == FILE:
+                fnames.append( name )
+            else:
+                subdirs.append( name )
+        return out
+
+    def walk( self, location, snapshot=None ):
+        """
+        Works like os.walk( location ), yielding (root, subdirs, fnames) top-down,
+         but reads from the catalog instead of the disk.  Call rescan() first
+         to pick up any changes.
+        """
+        location = os.path.abspath( location )
+        if snapshot == None:
+            snapshot = self.snapshot( location )
+        if location not in snapshot:
+            return
+        stack = [location]
+        while stack:
+            d = stack.pop()
+            subdirs, fnames = snapshot[d]
+            yield d, subdirs, fnames
+            # push in reverse so that we come back out in sorted order
+            stack.extend( [os.path.join(d, sd) for sd in reversed(subdirs) if os.path.join(d, sd) in snapshot] )
+
+_CATALOG = None
+_UNOPENABLE = set()  # catalog files we have already complained about
+
+def get_catalog( dbfile=DEFAULT_CATALOG ):
+    """
+    Returns the FileCatalog shared by this session (opening it if needed),
+     or None if the catalog file cannot be opened.
+    """
+    global _CATALOG
+    if (_CATALOG == None) or (_CATALOG.dbfile != dbfile):
+        try:
+            _CATALOG = FileCatalog( dbfile )
+        except sqlite3.Error, e:
+            if dbfile not in _UNOPENABLE:
+                print 'Cannot open the file catalog %s (%s); walking the disk instead.' %(dbfile, e)
+                _UNOPENABLE.add( dbfile )
+            return None
+    return _CATALOG
@@ -0,0 +1,135 @@
+"""
+A persistent cache of the info pulled out of FITS headers.
+
+get_info_spec_fitsfile and get_info_image_fitsfile are called over and over on
+ the same files (by add2db, update_names, extract_headers ...), in this session
+ and every later one.  This module keeps their results in a local SQLite file,
+ keyed by (path, kind) and only trusted while the file's size and mtime match,
+ so re-ingesting or re-auditing an archive rarely touches the FITS files at all.
+
+ > c = get_cache()
+ > c.stats()
+ {'entries': 12345, 'hits': 120, 'misses': 3}
+
+The cache holds at most <max_entries> rows; beyond that, the least recently
+ used ones are dropped.
+
+Entries are also keyed by the version of the parser that made them (see
+ SNDBLib.HEADER_INFO_VERSION), so a fix to the header parsing is never hidden
+ behind dictionaries cached by the old code.
+"""
+
+import os
+import time
+import sqlite3
+import cPickle as pickle
+
+DEFAULT_CACHE = os.path.join( os.path.expanduser('~'), '.sndb_header_cache.sqlite' )
+MAX_ENTRIES = 1000000
+# last-used times are only rewritten when older than this (s), to keep hits read-only
+TOUCH_INTERVAL = 86400.
+
+class HeaderCache( object ):
+    """
+    SQLite-backed cache of {(path, kind): info dictionary}, validated by size and mtime.
+    Any SQLite error is treated as a miss, so a broken cache never stops header reading.
+    """
+    def __init__( self, dbfile=DEFAULT_CACHE, max_entries=MAX_ENTRIES ):
+        self.dbfile = dbfile
+        self.max_entries = max_entries
+        self.pid = os.getpid()
+        self.hits, self.misses = 0, 0
+        self.puts_since_check = 0
+        self.conn = sqlite3.connect( dbfile, timeout=30 )
+        self.conn.text_factory = str
+        self.conn.execute( 'CREATE TABLE IF NOT EXISTS headers (path TEXT, kind TEXT, size INTEGER, mtime REAL, '+\
+                           'used REAL, info BLOB, PRIMARY KEY (path, kind));' )
+        self.conn.execute( 'CREATE INDEX IF NOT EXISTS headers_used ON headers (used);' )
+        self.conn.commit()
+
+    def close( self ):
+        self.conn.close()
+
+    def get( self, path, kind, version=0 ):
+        """
+        Returns the cached info dictionary for <path>, or None if it is missing, stale,
+         or was made by another <version> of the parser.
+        """
+        path = os.path.abspath( path )
+        kind = '%s:%d' %(kind, version)
+        try:
+            st = os.stat( path )
+            row = self.conn.execute( 'SELECT size, mtime, used, info FROM headers WHERE path = ? AND kind = ?;',
+                                     [path, kind] ).fetchone()
+            if (row == None) or (row[0] != st.st_size) or (row[1] != st.st_mtime):
+                self.misses += 1
+                return None
+            now = time.time()
+            if now - row[2] > TOUCH_INTERVAL:
+                with self.conn:
+                    self.conn.execute( 'UPDATE headers SET used = ? WHERE path = ? AND kind = ?;', [now, path, kind] )
+            self.hits += 1
+            return pickle.loads( str(row[3]) )
+        except (OSError, sqlite3.Error, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+    def put( self, path, kind, info, version=0 ):
+        """
+        Stores the info dictionary for <path>, as made by <version> of the parser.
+        """
+        path = os.path.abspath( path )
+        kind = '%s:%d' %(kind, version)
+        try:
+            st = os.stat( path )
+            blob = sqlite3.Binary( pickle.dumps( info, pickle.HIGHEST_PROTOCOL ) )
+            with self.conn:
+                self.conn.execute( 'INSERT OR REPLACE INTO headers (path, kind, size, mtime, used, info) VALUES (?, ?, ?, ?, ?, ?);',
+                                   [path, kind, st.st_size, st.st_mtime, time.time(), blob] )
+            self.puts_since_check += 1
+            if self.puts_since_check >= max( 1, self.max_entries/100 ):
+                self.evict()
+        except (OSError, sqlite3.Error):
+            pass
+
+    def evict( self ):
+        """
+        Drops the least recently used entries until the cache is back to 90% of max_entries.
+        """
+        self.puts_since_check = 0
+        n = self.conn.execute( 'SELECT COUNT(*) FROM headers;' ).fetchone()[0]
+        if n > self.max_entries:
+            with self.conn:
+                self.conn.execute( 'DELETE FROM headers WHERE rowid IN (SELECT rowid FROM headers ORDER BY used LIMIT ?);',
+                                   [n - int(0.9*self.max_entries)] )
+
+    def clear( self ):
+        with self.conn:
+            self.conn.execute( 'DELETE FROM headers;' )
+
+    def stats( self ):
+        """
+        Returns a dictionary with the number of entries and this session's hits and misses.
+        """
+        n = self.conn.execute( 'SELECT COUNT(*) FROM headers;' ).fetchone()[0]
+        return {'entries':n, 'hits':self.hits, 'misses':self.misses}
+
+_CACHE = None
+_UNOPENABLE = set()  # cache files we have already complained about
+
+def get_cache( dbfile=DEFAULT_CACHE ):
+    """
+    Returns the HeaderCache for this process, opening it if needed,
+     or None if the cache file cannot be opened.
+    (SQLite connections cannot be shared across a fork, so worker processes get their own.)
+    """
+    global _CACHE
+    if (_CACHE == None) or (_CACHE.dbfile != dbfile) or (_CACHE.pid != os.getpid()):
+        try:
+            _CACHE = HeaderCache( dbfile )
+        except sqlite3.Error, e:
+            if dbfile not in _UNOPENABLE:
+                print 'Cannot open the header cache %s (%s); reading headers uncached.' %(dbfile, e)
+                _UNOPENABLE.add( dbfile )
+            return None
+    return _CACHE
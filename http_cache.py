@@ -0,0 +1,385 @@
+"""
+A shared fetch layer for the web pages we scrape (SIMBAD, TNS, Rochester),
+ with an on-disk cache of the responses.
+
+The same host galaxy gets looked up on SIMBAD for every SN in it, and every
+ re-ingest asks TNS about the same objects again.  All those fetches now go
+ through fetch() or urlopen() here, which keep the responses in a local SQLite
+ file for a per-source TTL (see TTLS), so a batch import only hits the network
+ once per unique page.
+
+ > body = fetch( 'http://simbad.u-strasbg.fr/simbad/sim-id?output.format=ASCII&Ident=M101', 'simbad' )
+ > get_cache().stats()
+ {'entries': 1234, 'bytes': 5678901, 'hits': 10, 'misses': 2}
+
+Responses that say the object does not exist (a 404, or a page matching the
+ <not_found> regex) are cached too, for NEGATIVE_TTL, so we don't keep asking.
+If the network fails, an expired copy is used when there is one.
+In offline mode (set_offline(True), or SNDB_OFFLINE=1 in the environment) only the
+ cache is used, whatever its age, and a miss raises OfflineMiss.
+
+The cache holds at most <max_bytes> of (compressed) responses; beyond that,
+ the least recently used ones are dropped.
+
+Requests that do go out are held to RATE_LIMITS per source, and several threads
+ asking for the same url at once share a single request.
+"""
+
+import os
+import time
+import zlib
+import sqlite3
+import threading
+import urllib2
+from cStringIO import StringIO
+
+DEFAULT_CACHE = os.path.join( os.path.expanduser('~'), '.sndb_http_cache.sqlite' )
+MAX_BYTES = 500*1024*1024
+# how long (s) a response from each source is trusted
+TTLS = {'simbad':30*86400.,
+        'tns':7*86400.,
+        'rochester':86400.,
+        'default':86400.}
+# how long (s) a "not found" is trusted
+NEGATIVE_TTL = 86400.
+TIMEOUT = 60.
+# most requests per second (sustained, burst) we send to each source
+RATE_LIMITS = {'simbad':(5., 5),
+               'tns':(1., 3),
+               'rochester':(1., 2),
+               'default':(5., 5)}
+OFFLINE = os.environ.get( 'SNDB_OFFLINE', '' ) not in ['', '0']
+
+class NotFound( IOError ):
+    """
+    The server said the page does not exist (possibly a cached answer).
+    """
+    pass
+
+class OfflineMiss( IOError ):
+    """
+    Offline mode, and the page is not in the cache.
+    """
+    pass
+
+def set_offline( offline=True ):
+    """
+    Turns offline (cache-only) mode on or off for this session.
+    """
+    global OFFLINE
+    OFFLINE = offline
+
+class ResponseCache( object ):
+    """
+    SQLite-backed cache of {url: response body}, with the time each was fetched.
+    Any SQLite error is treated as a miss, so a broken cache never stops a fetch.
+    Safe to share between threads (the resolvers in SNDBLib fetch concurrently).
+    """
+    def __init__( self, dbfile=DEFAULT_CACHE, max_bytes=MAX_BYTES ):
+        self.dbfile = dbfile
+        self.max_bytes = max_bytes
+        self.pid = os.getpid()
+        self.hits, self.misses = 0, 0
+        self.bytes_since_check = 0
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect( dbfile, timeout=30, check_same_thread=False )
+        self.conn.text_factory = str
+        self.conn.execute( 'CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, fetched REAL, used REAL, '+\
+                           'negative INTEGER, size INTEGER, body BLOB);' )
+        self.conn.execute( 'CREATE INDEX IF NOT EXISTS responses_used ON responses (used);' )
+        self.conn.commit()
+
+    def close( self ):
+        self.conn.close()
+
+    def get( self, url ):
+        """
+        Returns (time fetched, negative, body) for url, or None if it is not cached.
+        Expiry is up to the caller.
+        """
+        try:
+            with self.lock:
+                row = self.conn.execute( 'SELECT fetched, negative, body FROM responses WHERE url = ?;', [url] ).fetchone()
+                if row == None:
+                    return None
+                with self.conn:
+                    self.conn.execute( 'UPDATE responses SET used = ? WHERE url = ?;', [time.time(), url] )
+            return row[0], bool(row[1]), zlib.decompress( str(row[2]) )
+        except (sqlite3.Error, zlib.error):
+            return None
+
+    def put( self, url, body, negative=False ):
+        try:
+            blob = zlib.compress( body, 6 )
+            now = time.time()
+            with self.lock:
+                with self.conn:
+                    self.conn.execute( 'INSERT OR REPLACE INTO responses (url, fetched, used, negative, size, body) VALUES (?, ?, ?, ?, ?, ?);',
+                                       [url, now, now, int(negative), len(blob), sqlite3.Binary(blob)] )
+                self.bytes_since_check += len(blob)
+                if self.bytes_since_check >= self.max_bytes/100:
+                    self.evict()
+        except sqlite3.Error:
+            pass
+
+    def evict( self ):
+        """
+        Drops the least recently used responses until the cache is back under 90% of max_bytes.
+        """
+        with self.lock:
+            self._evict()
+
+    def _evict( self ):
+        self.bytes_since_check = 0
+        total = self.conn.execute( 'SELECT COALESCE(SUM(size), 0) FROM responses;' ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(0.9*self.max_bytes)
+        drop, dropped = [], 0
+        for url, size in self.conn.execute( 'SELECT url, size FROM responses ORDER BY used;' ):
+            if dropped >= target:
+                break
+            drop.append( [url] )
+            dropped += size
+        with self.conn:
+            self.conn.executemany( 'DELETE FROM responses WHERE url = ?;', drop )
+
+    def clear( self ):
+        with self.lock:
+            with self.conn:
+                self.conn.execute( 'DELETE FROM responses;' )
+
+    def stats( self ):
+        """
+        Returns a dictionary with the number of entries, their size, and this session's hits and misses.
+        """
+        with self.lock:
+            n, total = self.conn.execute( 'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses;' ).fetchone()
+        return {'entries':n, 'bytes':total, 'hits':self.hits, 'misses':self.misses}
+
+class NoCache( object ):
+    """
+    Stands in for the ResponseCache when its file cannot be opened: nothing is
+     ever found or kept, so every request goes to the network.
+    """
+    def __init__( self, dbfile ):
+        self.dbfile = dbfile
+        self.pid = os.getpid()
+        self.hits, self.misses = 0, 0
+
+    def close( self ):
+        pass
+
+    def get( self, url ):
+        return None
+
+    def put( self, url, body, negative=False ):
+        pass
+
+    def clear( self ):
+        pass
+
+    def stats( self ):
+        return {'entries':0, 'bytes':0, 'hits':self.hits, 'misses':self.misses}
+
+class TokenBucket( object ):
+    """
+    Rate limiter: allows bursts of up to <burst> calls, refilling at <rate> per second.
+    take() blocks until a call is allowed.
+    """
+    def __init__( self, rate, burst ):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take( self ):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min( self.burst, self.tokens + (now - self.last)*self.rate )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep( wait )
+
+_BUCKETS = {}
+_BUCKETS_LOCK = threading.Lock()
+
+def throttle( source ):
+    """
+    Waits until we are allowed to send another request to <source> (see RATE_LIMITS).
+    """
+    with _BUCKETS_LOCK:
+        if source not in _BUCKETS:
+            _BUCKETS[source] = TokenBucket( *RATE_LIMITS.get( source, RATE_LIMITS['default'] ) )
+        bucket = _BUCKETS[source]
+    bucket.take()
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+# urls being fetched right now: threading.Event set when done
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+def get_cache( dbfile=DEFAULT_CACHE ):
+    """
+    Returns the ResponseCache for this process, opening it if needed.
+    If the cache file cannot be opened, returns a NoCache, so that fetches still go out.
+    """
+    global _CACHE
+    with _CACHE_LOCK:
+        if (_CACHE == None) or (_CACHE.dbfile != dbfile) or (_CACHE.pid != os.getpid()):
+            try:
+                _CACHE = ResponseCache( dbfile )
+            except sqlite3.Error, e:
+                print 'Cannot open the http cache %s (%s); fetching everything uncached.' %(dbfile, e)
+                _CACHE = NoCache( dbfile )
+        return _CACHE
+
+def _lookup( url, source, ttl ):
+    """
+    Returns (cached entry or None, whether it is still fresh).
+    """
+    cached = get_cache().get( url )
+    if cached == None:
+        return None, False
+    fetched, negative, body = cached
+    if ttl == None:
+        ttl = NEGATIVE_TTL if negative else TTLS.get( source, TTLS['default'] )
+    return cached, OFFLINE or (time.time() - fetched <= ttl)
+
+def _answer( url, cached ):
+    fetched, negative, body = cached
+    if negative and not body:
+        raise NotFound( 'not found: %s (cached %s)' %(url, time.ctime(fetched)) )
+    return body
+
+def _is_negative( body, not_found ):
+    return (not_found != None) and (not_found.search( body ) != None)
+
+def fetch( url, source='default', not_found=None, ttl=None ):
+    """
+    Returns the body of the page at url, from the cache if we have a fresh enough copy.
+    <source> picks the TTL from TTLS (or pass ttl, in seconds, to override it).
+    If <not_found> is a compiled regex and it matches the page, the page is only
+     cached for NEGATIVE_TTL (but still returned).  A 404 raises NotFound.
+    If another thread is already fetching the same url, waits for its answer
+     instead of asking the server twice.
+    """
+    cache = get_cache()
+    cached, fresh = _lookup( url, source, ttl )
+    if fresh:
+        cache.hits += 1
+        return _answer( url, cached )
+    if OFFLINE:
+        raise OfflineMiss( 'offline, and not in the cache: %s' %url )
+    with _INFLIGHT_LOCK:
+        leader = url not in _INFLIGHT
+        if leader:
+            _INFLIGHT[url] = threading.Event()
+        done = _INFLIGHT[url]
+    if not leader:
+        done.wait( TIMEOUT )
+        cached, fresh = _lookup( url, source, ttl )
+        if fresh:
+            cache.hits += 1
+            return _answer( url, cached )
+        # the other fetch failed; try for ourselves
+        return _fetch_live( url, source, not_found, cached )
+    try:
+        return _fetch_live( url, source, not_found, cached )
+    finally:
+        with _INFLIGHT_LOCK:
+            del _INFLIGHT[url]
+        done.set()
+
+def _fetch_live( url, source, not_found, cached ):
+    """
+    Fetches url from the server (falling back on the expired copy <cached> if that fails).
+    """
+    cache = get_cache()
+    cache.misses += 1
+    try:
+        throttle( source )
+        body = urllib2.urlopen( url, timeout=TIMEOUT ).read()
+    except urllib2.HTTPError, e:
+        if e.code == 404:
+            cache.put( url, '', negative=True )
+            raise NotFound( 'not found: %s' %url )
+        if cached == None:
+            raise
+        print 'Fetching %s failed (%s); using the copy from %s.' %(url, e, time.ctime(cached[0]))
+        return _answer( url, cached )
+    except IOError, e:
+        if cached == None:
+            raise
+        print 'Fetching %s failed (%s); using the copy from %s.' %(url, e, time.ctime(cached[0]))
+        return _answer( url, cached )
+    cache.put( url, body, negative=_is_negative( body, not_found ) )
+    return body
+
+class _TeeResponse( object ):
+    """
+    Wraps an open urllib2 response, keeping a copy of everything read, and stores
+     the full body in the cache when it is closed.
+    """
+    def __init__( self, url, response, not_found=None ):
+        self.url = url
+        self.response = response
+        self.not_found = not_found
+        self.chunks = []
+        self.eof = False
+
+    def read( self, n=-1 ):
+        chunk = self.response.read( n ) if n >= 0 else self.response.read()
+        if (not chunk) or (n < 0):
+            self.eof = True
+        self.chunks.append( chunk )
+        return chunk
+
+    def close( self ):
+        if self.response == None:
+            return
+        try:
+            if not self.eof:
+                # read whatever the caller didn't need, so the whole page is cached
+                self.chunks.append( self.response.read() )
+            body = ''.join( self.chunks )
+            get_cache().put( self.url, body, negative=_is_negative( body, self.not_found ) )
+        except IOError:
+            pass
+        finally:
+            self.response.close()
+            self.response, self.chunks = None, []
+
+def urlopen( url, source='default', not_found=None, ttl=None ):
+    """
+    Like fetch(), but returns an open file-like object, so that big pages can be
+     parsed as they stream in.  Close it when done to store the page in the cache.
+    """
+    cache = get_cache()
+    cached, fresh = _lookup( url, source, ttl )
+    if fresh:
+        cache.hits += 1
+        return StringIO( _answer( url, cached ) )
+    if OFFLINE:
+        raise OfflineMiss( 'offline, and not in the cache: %s' %url )
+    cache.misses += 1
+    try:
+        throttle( source )
+        return _TeeResponse( url, urllib2.urlopen( url, timeout=TIMEOUT ), not_found )
+    except urllib2.HTTPError, e:
+        if e.code == 404:
+            cache.put( url, '', negative=True )
+            raise NotFound( 'not found: %s' %url )
+        if cached == None:
+            raise
+    except IOError, e:
+        if cached == None:
+            raise
+    print 'Fetching %s failed; using the copy from %s.' %(url, time.ctime(cached[0]))
+    return StringIO( _answer( url, cached ) )
@@ -0,0 +1,61 @@
+"""
+A persistent copy of the parsed Rochester SN catalog (SNDBLib.ROCHESTER_DICT).
+
+Downloading and parsing the two Rochester pages takes ~10s or more, and used to
+ happen in every new session that looked anything up there.  The parsed dictionary
+ is now saved to a single compressed pickle, stamped with the time it was fetched
+ and a format version, so later sessions can load it in a fraction of a second.
+
+ > SNDBLib.load_rochester_info()      # from this cache if it is fresh enough
+ > SNDBLib.refresh_rochester_info()   # always download, and re-save
+
+load() returns (None, None) if the file is missing, unreadable, from another
+ version of this format, or older than <ttl> seconds.
+"""
+
+import os
+import time
+import zlib
+import cPickle as pickle
+
+DEFAULT_CACHE = os.path.join( os.path.expanduser('~'), '.sndb_rochester.pkl.z' )
+# bump this whenever the layout of ROCHESTER_DICT entries changes
+VERSION = 1
+# refetch the pages once the saved copy is older than this (s)
+TTL = 7*86400.
+
+def load( cachefile=DEFAULT_CACHE, ttl=TTL ):
+    """
+    Returns (dictionary, time it was fetched) from the cache file, or (None, None)
+     if there is no usable copy.  Use ttl=None to accept a copy of any age.
+    """
+    try:
+        with open( cachefile, 'rb' ) as f:
+            version, fetched, d = pickle.loads( zlib.decompress( f.read() ) )
+    except (IOError, OSError, EOFError, ValueError, TypeError, zlib.error, pickle.UnpicklingError):
+        return None, None
+    if version != VERSION:
+        return None, None
+    if (ttl != None) and (time.time() - fetched > ttl):
+        return None, None
+    return d, fetched
+
+def save( d, cachefile=DEFAULT_CACHE, fetched=None ):
+    """
+    Writes dictionary d to the cache file, stamped with <fetched> (default: now).
+    The file is written to a temporary name first and moved into place, so a
+     concurrent reader never sees half of it.
+    """
+    if fetched == None:
+        fetched = time.time()
+    tmp = '%s.%d.tmp' %(cachefile, os.getpid())
+    try:
+        with open( tmp, 'wb' ) as f:
+            f.write( zlib.compress( pickle.dumps( (VERSION, fetched, d), pickle.HIGHEST_PROTOCOL ), 6 ) )
+        os.rename( tmp, cachefile )
+    except (IOError, OSError), e:
+        print 'Could not save the Rochester cache to %s: %s' %(cachefile, e)
+        try:
+            os.remove( tmp )
+        except OSError:
+            pass
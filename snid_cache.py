@@ -0,0 +1,179 @@
+"""
+A persistent cache of SNID results.
+
+Running SNID is the slowest step in handling a spectrum, and re-runs, duplicated
+ files and repeated ingests of the same spectrum used to redo it every time.
+ getSNID now keeps each result in a local SQLite file, keyed by
+
+ - a hash of the .flm file's contents (so copies and renamed files share results),
+ - a fingerprint of the snid executable and its template set (see fingerprint()),
+ - the options snid was run with,
+
+ along with the raw output SNID printed.  Updating the templates (or snid itself)
+ changes the fingerprint, so every result computed with the old set is ignored
+ from then on, and results for other template sets are left alone.
+
+ > c = get_cache()
+ > c.stats()
+ {'entries': 12345, 'fingerprints': 2, 'hits': 120, 'misses': 3}
+
+The template folder is SNID_TEMPLATES (in the environment, or the module constant)
+ if set, or else a templates* folder next to (or one up from) the snid executable,
+ where SNID installs them.  If neither exists, template changes could not be
+ noticed, so no results are cached or read back at all.
+"""
+
+import os
+import shlex
+import sqlite3
+import glob
+import hashlib
+from distutils.spawn import find_executable
+
+DEFAULT_CACHE = os.path.join( os.path.expanduser('~'), '.sndb_snid_cache.sqlite' )
+SNID_TEMPLATES = os.environ.get( 'SNID_TEMPLATES', '' )
+
+def content_hash( fname ):
+    """
+    Returns the sha1 hex digest of a file's contents.
+    """
+    h = hashlib.sha1()
+    with open( fname, 'rb' ) as f:
+        for chunk in iter( lambda: f.read(1<<20), '' ):
+            h.update( chunk )
+    return h.hexdigest()
+
+def _executables( snid_cmd ):
+    """
+    Returns the absolute paths of the files named in <snid_cmd>.
+    """
+    out = []
+    for word in shlex.split( snid_cmd ):
+        p = word if os.path.isfile( word ) else find_executable( word )
+        if p:
+            out.append( os.path.abspath( p ) )
+    return out
+
+def template_dir( snid_cmd, templates=None ):
+    """
+    Returns the template folder snid uses: <templates> (default SNID_TEMPLATES) if
+     given, or else the first templates* folder next to or one up from any file
+     named in <snid_cmd>.  Returns None if there is no such folder.
+    """
+    if templates == None:
+        templates = SNID_TEMPLATES
+    if templates:
+        return templates if os.path.isdir( templates ) else None
+    for p in _executables( snid_cmd ):
+        d = os.path.dirname( os.path.realpath( p ) )
+        for found in sorted( glob.glob( os.path.join(d, 'templates*') ) ) + sorted( glob.glob( os.path.join(d, '..', 'templates*') ) ):
+            if os.path.isdir( found ):
+                return os.path.abspath( found )
+    return None
+
+_FINGERPRINTS = {}
+_NO_TEMPLATES = set()  # snid commands we have already complained about
+
+def fingerprint( snid_cmd, templates=None ):
+    """
+    Returns a short hash identifying the snid executable (every file named in
+     <snid_cmd>, by path, size and mtime) and the template set (every file in the
+     template folder, see template_dir, likewise).
+    Returns None if the template folder cannot be found; results must not be
+     cached then, since a template update would go unnoticed.
+    Worked out once per process.
+    """
+    key = (snid_cmd, templates)
+    if key not in _FINGERPRINTS:
+        tdir = template_dir( snid_cmd, templates )
+        if tdir == None:
+            if snid_cmd not in _NO_TEMPLATES:
+                print 'Cannot find the SNID templates for %s (set SNID_TEMPLATES); not caching SNID results.' %snid_cmd
+                _NO_TEMPLATES.add( snid_cmd )
+            _FINGERPRINTS[key] = None
+            return None
+        h = hashlib.sha1()
+        for p in _executables( snid_cmd ):
+            st = os.stat( p )
+            h.update( '%s %d %r\n' %(p, st.st_size, st.st_mtime) )
+        h.update( 'templates %s\n' %tdir )
+        for root, subdirs, fnames in os.walk( tdir ):
+            subdirs.sort()
+            for f in sorted( fnames ):
+                st = os.stat( os.path.join(root, f) )
+                h.update( '%s %d %r\n' %(os.path.relpath( os.path.join(root, f), tdir ), st.st_size, st.st_mtime) )
+        _FINGERPRINTS[key] = h.hexdigest()[:16]
+    return _FINGERPRINTS[key]
+
+class SNIDCache( object ):
+    """
+    SQLite-backed cache of {(spectrum hash, snid fingerprint, options): (type, subtype, raw output)}.
+    Any SQLite error is treated as a miss, so a broken cache never stops SNID from running.
+    """
+    def __init__( self, dbfile=DEFAULT_CACHE ):
+        self.dbfile = dbfile
+        self.pid = os.getpid()
+        self.hits, self.misses = 0, 0
+        # several snid_everything workers may write at once
+        self.conn = sqlite3.connect( dbfile, timeout=60 )
+        self.conn.text_factory = str
+        self.conn.execute( 'CREATE TABLE IF NOT EXISTS results (spectrum TEXT, fingerprint TEXT, options TEXT, '+\
+                           'type TEXT, subtype TEXT, output BLOB, PRIMARY KEY (spectrum, fingerprint, options));' )
+        self.conn.commit()
+
+    def close( self ):
+        self.conn.close()
+
+    def get( self, spectrum, fprint, options ):
+        """
+        Returns (type, subtype, raw output), or None if this spectrum has not been run
+         with this snid and these options.
+        """
+        try:
+            row = self.conn.execute( 'SELECT type, subtype, output FROM results WHERE spectrum = ? AND fingerprint = ? AND options = ?;',
+                                     [spectrum, fprint, options] ).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row == None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0], row[1], str(row[2])
+
+    def put( self, spectrum, fprint, options, t, st, output ):
+        try:
+            with self.conn:
+                self.conn.execute( 'INSERT OR REPLACE INTO results (spectrum, fingerprint, options, type, subtype, output) VALUES (?, ?, ?, ?, ?, ?);',
+                                   [spectrum, fprint, options, t, st, sqlite3.Binary(output)] )
+        except sqlite3.Error:
+            pass
+
+    def forget_fingerprint( self, fprint ):
+        """
+        Drops every result computed with the snid/template set <fprint>.
+        """
+        with self.conn:
+            self.conn.execute( 'DELETE FROM results WHERE fingerprint = ?;', [fprint] )
+
+    def stats( self ):
+        n, nf = self.conn.execute( 'SELECT COUNT(*), COUNT(DISTINCT fingerprint) FROM results;' ).fetchone()
+        return {'entries':n, 'fingerprints':nf, 'hits':self.hits, 'misses':self.misses}
+
+_CACHE = None
+_UNOPENABLE = set()  # cache files we have already complained about
+
+def get_cache( dbfile=DEFAULT_CACHE ):
+    """
+    Returns the SNIDCache for this process, opening it if needed,
+     or None if the cache file cannot be opened.
+    """
+    global _CACHE
+    if (_CACHE == None) or (_CACHE.dbfile != dbfile) or (_CACHE.pid != os.getpid()):
+        try:
+            _CACHE = SNIDCache( dbfile )
+        except sqlite3.Error, e:
+            if dbfile not in _UNOPENABLE:
+                print 'Cannot open the SNID cache %s (%s); running SNID uncached.' %(dbfile, e)
+                _UNOPENABLE.add( dbfile )
+            return None
+    return _CACHE
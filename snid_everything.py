@@ -2,38 +2,204 @@
 Goes through all spectra in the SNDB and attempts to re-run SNID on them
  to update the SNDB entry.  Should probably be run any time we update
  SNID templates, et cetera.
+
+To use:
+ > python snid_everything.py [--nprocs N] [--batch N] [--snid /path/to/snid]
+
+SNID runs on a pool of worker processes, each in its own scratch folder below
+ ./tmp (to make it easy to delete SNID outfile crap).  Every spectrum that is
+ done gets its SpecID written to a checkpoint file, so if the run is killed,
+ running it again picks up where it stopped; delete the checkpoint to start over.
+ Once a run gets through every spectrum, the checkpoint is renamed to *.complete
+ so the next run starts from scratch.
+
+The spectra are streamed from the DB over their own connection with an unbuffered
+ (server-side) cursor, so memory use does not grow with the table, and the new
+ types go back over a second connection in batches of --batch updates per
+ transaction.  A SpecID only goes into the checkpoint once its batch is committed.
 """
 
-import MySQLdb
-import MySQLdb.cursors
-import credentials as creds
-import SNDBLib, add2db
-DB = MySQLdb.connect(host=creds.host, user=creds.user, passwd=creds.passwd, db=creds.db, cursorclass=MySQLdb.cursors.DictCursor)
+import os
+import sys
+import shutil
+import tempfile
+import optparse
+from multiprocessing import Pool, cpu_count
+import SNDBLib
+import db_pool
+DB = db_pool.lazy_connection()
 
 root_dir = '/media/raid0/'
 workingdir = './tmp'
-import os
-os.chdir(workingdir)
-# do all work in a subfolder to make it easy to delete SNID outfile crap
+checkpoint_file = './tmp/snid_everything.done'
 
 # sqlfind = 'SELECT Filename,Filepath,SpecID,SNID_Type,SNID_Subtype FROM spectra;'
 sqlfind = 'SELECT Filename,Filepath,SpecID,SNID_Type,SNID_Subtype FROM spectra WHERE SNID_Type = "NoMatch";'
-c = DB.cursor()
-c.execute(sqlfind)
-while True:
-    r = c.fetchoneDict()
-    if r == None:
-        print 'All done!'
-        break
+sqlupdate = "UPDATE spectra SET SNID_Type = %s, SNID_Subtype = %s WHERE (SpecID = %s);"
+# the server drops a streaming client that stops reading for longer than net_write_timeout,
+#  which the SNID runs between fetches can easily exceed
+STREAM_TIMEOUT = 24*3600
+
+def iter_spectra( sql=sqlfind, batch=1000 ):
+    """
+    Yields the rows of <sql> from the spectra table, streamed from the server <batch> at a time.
+    Uses a connection of its own, since nothing else can be sent over a connection
+     while an unbuffered result is being read from it.
+    """
+    conn = db_pool.connect( stream=True )
+    try:
+        c = conn.cursor()
+        try:
+            c.execute( 'SET SESSION net_write_timeout = %d;' %STREAM_TIMEOUT )
+        except db_pool.ERRORS:
+            pass
+        c.execute( sql )
+        while True:
+            rows = c.fetchmany( batch )
+            if not rows:
+                break
+            for r in rows:
+                yield r
+        c.close()
+    finally:
+        conn.close()
+
+def load_checkpoint( fname=checkpoint_file ):
+    """
+    Returns the set of SpecIDs already done, according to the checkpoint file.
+    """
+    done = set()
+    if os.path.exists( fname ):
+        for l in open( fname ):
+            try:
+                done.add( int(l) )
+            except ValueError:
+                # a line cut short when the last run was killed
+                pass
+    return done
+
+_SCRATCH = None
+_SNID = None
+_USE_CACHE = True
+
+def _init_worker( scratch_root, snid, use_cache ):
+    """
+    Gives each worker process its own scratch folder, so SNID runs never see each other's files.
+    """
+    global _SCRATCH, _SNID, _USE_CACHE
+    _SCRATCH = tempfile.mkdtemp( prefix='snid_%d_' %os.getpid(), dir=scratch_root )
+    _SNID = snid
+    _USE_CACHE = use_cache
+
+def _run_one( r ):
     fullpath = root_dir + r['Filepath'] + '/' + r['Filename']
-    t,st = SNDBLib.getSNID( fullpath )
-    if (t != r['SNID_Type']) or (st != r['SNID_Subtype']):
-        # update only if needed
-        sqlupdate = "UPDATE spectra SET SNID_Type = %s, SNID_Subtype = %s WHERE (SpecID = %s);"
-        vals = [t,st,r['SpecID']]
-        print r['Filename'],'update:'
-        add2db.print_sql( sqlupdate, vals )
-        c.execute( sqlupdate, vals )
-        DB.commit()
-    else:
-        print r['Filename'],': no update.'
\ No newline at end of file
+    t,st = SNDBLib.getSNID( fullpath, workdir=_SCRATCH, snid=_SNID, use_cache=_USE_CACHE )
+    # clear out SNID's output files before the next run
+    for f in os.listdir( _SCRATCH ):
+        try:
+            os.remove( os.path.join(_SCRATCH, f) )
+        except OSError:
+            pass
+    return r, t, st
+
+class UpdateBatch( object ):
+    """
+    Collects new SNID types and writes them to the DB <size> updates per transaction,
+     appending the SpecIDs to the checkpoint file once they are committed.
+    """
+    def __init__( self, conn, ckpt, size=100 ):
+        self.conn = conn
+        self.ckpt = ckpt
+        self.size = size
+        self.updates = []
+        self.specids = []
+
+    def add( self, r, t, st ):
+        if (t != r['SNID_Type']) or (st != r['SNID_Subtype']):
+            # update only if needed
+            print r['Filename'],'update:',t,st
+            self.updates.append( [t,st,r['SpecID']] )
+        else:
+            print r['Filename'],': no update.'
+        self.specids.append( r['SpecID'] )
+        if len(self.updates) >= self.size:
+            self.flush()
+
+    def flush( self ):
+        if self.updates:
+            with self.conn.transaction() as c:
+                c.executemany( sqlupdate, self.updates )
+        for specid in self.specids:
+            self.ckpt.write( '%d\n' %specid )
+        self.ckpt.flush()
+        self.updates, self.specids = [], []
+
+def run( nprocs=None, sql=sqlfind, checkpoint=checkpoint_file, scratch_root=workingdir, snid=None, chunk=None, use_cache=True, batch=100 ):
+    """
+    Re-runs SNID on every spectrum selected by <sql> (skipping those already in the
+     checkpoint file, which is renamed to <checkpoint>.complete once every spectrum
+     is done) with <nprocs> processes (default: one per core), and updates the DB
+     <batch> spectra per transaction.
+    Spectra already run with the current snid and templates come from the SNID
+     result cache (see snid_cache.py) unless use_cache == False.
+    """
+    if nprocs == None:
+        nprocs = cpu_count()
+    if chunk == None:
+        # enough to keep every worker busy, without pulling the whole table into the queue
+        chunk = 50*nprocs
+    if not os.path.isdir( scratch_root ):
+        os.makedirs( scratch_root )
+    done = load_checkpoint( checkpoint )
+    if done:
+        print 'Skipping %d spectra already done.' %len(done)
+    # this run's workers make their scratch folders in here, and only this is cleaned up after
+    run_scratch = tempfile.mkdtemp( prefix='snid_run_%d_' %os.getpid(), dir=scratch_root )
+    pool = Pool( nprocs, _init_worker, (run_scratch, snid, use_cache) )
+    ckpt = open( checkpoint, 'a' )
+    updates = UpdateBatch( DB, ckpt, batch )
+    ndone = 0
+    try:
+        todo = []
+        rows = iter_spectra( sql )
+        while True:
+            for r in rows:
+                if r['SpecID'] not in done:
+                    todo.append( r )
+                if len(todo) >= chunk:
+                    break
+            if not todo:
+                break
+            for r, t, st in pool.imap_unordered( _run_one, todo ):
+                updates.add( r, t, st )
+                ndone += 1
+            todo = []
+        pool.close()
+        pool.join()
+        updates.flush()
+    except:
+        exc = sys.exc_info()
+        pool.terminate()
+        pool.join()
+        # keep whatever finished before the interruption, without hiding what went wrong
+        try:
+            updates.flush()
+        except Exception, e:
+            print 'Could not save the last %d results: %s' %(len(updates.specids), e)
+        raise exc[0], exc[1], exc[2]
+    finally:
+        ckpt.close()
+        shutil.rmtree( run_scratch, ignore_errors=True )
+    # a finished run must not make the next one (e.g. after a template update) skip everything
+    os.rename( checkpoint, checkpoint+'.complete' )
+    print 'All done! (%d spectra this run)' %ndone
+
+if __name__ == '__main__':
+    p = optparse.OptionParser()
+    p.add_option( '--nprocs', type='int', default=None, help='number of SNID processes (default: one per core)' )
+    p.add_option( '--snid', default=None, help='SNID executable to run (default: %s)' %SNDBLib.SNID_CMD )
+    p.add_option( '--checkpoint', default=checkpoint_file, help='file of SpecIDs already done' )
+    p.add_option( '--batch', type='int', default=100, help='number of updates per DB transaction' )
+    p.add_option( '--no-cache', action='store_false', dest='use_cache', default=True, help='rerun SNID even on spectra in the SNID result cache' )
+    opts, args = p.parse_args()
+    run( nprocs=opts.nprocs, checkpoint=opts.checkpoint, snid=opts.snid, use_cache=opts.use_cache, batch=opts.batch )
@@ -0,0 +1,173 @@
+"""
+A binary copy of our ascii .flm spectra, for reading them back fast.
+
+Every analysis over the archive (SNR, resolution, SNID reruns, plots) used to
+ re-parse the ascii .flm files.  This module converts each one once into a few
+ large append-only files of float64 values (the .flm columns, row by row) plus
+ an SQLite index of where each spectrum starts, and hands them back as read-only
+ NumPy views onto memory maps of those files, with no parsing or copying at all.
+
+Spectra are keyed like the SNDB keys them, by Filepath/Filename below
+ DATA_ROOT (e.g. 'Data/spectra/sn2016abc/sn2016abc-20160101.flm'), and an entry
+ is only trusted while the .flm file's size and mtime match.
+
+ > store = get_store()
+ > store.convert( [key1, key2, ...], SNDBLib.read_flm )
+ > d = store.get( key1 )   # d[:,0] is wavelength, d[:,1] flux
+
+Replaced or stale spectra are appended again rather than overwritten, so the
+ data files only grow; delete the store directory to rebuild it from scratch.
+"""
+
+import os
+import sqlite3
+import numpy as np
+
+DATA_ROOT = '/media/raid0/'
+DEFAULT_STORE = os.path.join( os.path.expanduser('~'), '.sndb_spectra' )
+# start a new data file once the current one is this big
+SHARD_BYTES = 1<<30
+DTYPE = np.dtype( '<f8' )
+
+class SpectrumStore( object ):
+    """
+    Append-only binary store of spectra arrays, indexed in SQLite and read through np.memmap.
+    """
+    def __init__( self, location=DEFAULT_STORE, root=DATA_ROOT ):
+        self.location = location
+        self.root = root
+        self.pid = os.getpid()
+        if not os.path.isdir( location ):
+            os.makedirs( location )
+        self.conn = sqlite3.connect( os.path.join(location, 'index.sqlite'), timeout=60 )
+        self.conn.text_factory = str
+        self.conn.execute( 'CREATE TABLE IF NOT EXISTS spectra (key TEXT PRIMARY KEY, size INTEGER, mtime REAL, '+\
+                           'shard INTEGER, offset INTEGER, nrows INTEGER, ncols INTEGER);' )
+        self.conn.commit()
+        self.maps = {}  # shard: np.memmap of it
+
+    def close( self ):
+        self.conn.close()
+        self.maps = {}
+
+    def key_for( self, path ):
+        """
+        Returns the key for an absolute path below root, or None if it is not below root.
+        """
+        path = os.path.abspath( path )
+        root = os.path.abspath( self.root ) + '/'
+        if not path.startswith( root ):
+            return None
+        return path[len(root):]
+
+    def _shard_file( self, shard ):
+        return os.path.join( self.location, 'shard_%04d.f8' %shard )
+
+    def _map( self, shard, end ):
+        """
+        Returns a memory map of the shard covering at least <end> values.
+        """
+        mm = self.maps.get( shard )
+        if (mm is None) or (mm.size < end):
+            mm = np.memmap( self._shard_file(shard), dtype=DTYPE, mode='r' )
+            self.maps[shard] = mm
+        return mm
+
+    def _stat( self, key ):
+        try:
+            st = os.stat( os.path.join(self.root, key) )
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def get( self, key, validate=True ):
+        """
+        Returns a read-only (nrows, ncols) view of the spectrum, or None if it is not
+         in the store or (if validate) the .flm has changed since it was stored.
+        """
+        row = self.conn.execute( 'SELECT size, mtime, shard, offset, nrows, ncols FROM spectra WHERE key = ?;', [key] ).fetchone()
+        if row == None:
+            return None
+        size, mtime, shard, offset, nrows, ncols = row
+        if validate and (self._stat( key ) != (size, mtime)):
+            return None
+        end = offset + nrows*ncols
+        try:
+            return self._map( shard, end )[offset:end].reshape( (nrows, ncols) )
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put_many( self, items ):
+        """
+        Stores a list of (key, 2D array) pairs in one transaction.
+        """
+        if not items:
+            return
+        with self.conn:
+            # take the write lock first, so that writers in other processes append one at a time
+            self.conn.execute( 'BEGIN IMMEDIATE;' )
+            shard = self.conn.execute( 'SELECT COALESCE(MAX(shard), 0) FROM spectra;' ).fetchone()[0]
+            f = open( self._shard_file(shard), 'ab' )
+            f.seek( 0, 2 )
+            try:
+                for key, data in items:
+                    st = self._stat( key )
+                    if st == None:
+                        continue
+                    data = np.ascontiguousarray( np.atleast_2d(data), dtype=DTYPE )
+                    if f.tell() + data.nbytes > SHARD_BYTES and f.tell() > 0:
+                        f.close()
+                        shard += 1
+                        f = open( self._shard_file(shard), 'ab' )
+                    offset = f.tell() / DTYPE.itemsize
+                    f.write( data.tostring() )
+                    self.conn.execute( 'INSERT OR REPLACE INTO spectra (key, size, mtime, shard, offset, nrows, ncols) VALUES (?, ?, ?, ?, ?, ?, ?);',
+                                       [key, st[0], st[1], shard, offset, data.shape[0], data.shape[1]] )
+                f.flush()
+                os.fsync( f.fileno() )
+            finally:
+                f.close()
+
+    def put( self, key, data ):
+        self.put_many( [(key, data)] )
+
+    def convert( self, keys, reader, batch=500 ):
+        """
+        Makes sure every one of <keys> is in the store and up to date, parsing the .flm
+         files that are not with reader( path ) (e.g. SNDBLib.read_flm).
+        Returns (number converted, number that failed to parse).
+        """
+        nconverted, nfailed = 0, 0
+        items = []
+        for key in keys:
+            if self.get( key ) is not None:
+                continue
+            try:
+                data = reader( os.path.join(self.root, key) )
+            except (IOError, OSError, ValueError), e:
+                print 'Cannot convert %s: %s' %(key, e)
+                nfailed += 1
+                continue
+            items.append( (key, data) )
+            if len(items) >= batch:
+                self.put_many( items )
+                nconverted += len(items)
+                items = []
+        self.put_many( items )
+        nconverted += len(items)
+        return nconverted, nfailed
+
+    def stats( self ):
+        n, nvals = self.conn.execute( 'SELECT COUNT(*), COALESCE(SUM(nrows*ncols), 0) FROM spectra;' ).fetchone()
+        return {'spectra':n, 'bytes':nvals*DTYPE.itemsize}
+
+_STORE = None
+
+def get_store( location=DEFAULT_STORE, root=DATA_ROOT ):
+    """
+    Returns the SpectrumStore for this process, opening it if needed.
+    """
+    global _STORE
+    if (_STORE == None) or (_STORE.location != location) or (_STORE.root != root) or (_STORE.pid != os.getpid()):
+        _STORE = SpectrumStore( location, root )
+    return _STORE
@@ -5,13 +5,11 @@ Interactively search for objects in the SNDB that have been given updated names.
 
 """
 
-import MySQLdb
-import MySQLdb.cursors
-import credentials as creds
 import SNDBLib
+import db_pool
 import re, glob
 
-DB = MySQLdb.connect(host=creds.host, user=creds.user, passwd=creds.passwd, db=creds.db, cursorclass=MySQLdb.cursors.DictCursor)
+DB = db_pool.lazy_connection()
 
 def print_sql( sql, vals=None ):
     """
@@ -0,0 +1,297 @@
+"""
+Watch the spectra and photometry folders and push new files into the SNDB
+ as soon as they land, instead of remembering to run import_spec_from_folder
+ (or move_files) after every reduction.
+
+To use:
+ > python watch_folders.py
+or
+ > import watch_folders
+ > watch_folders.watch()
+
+Uses Linux inotify (through ctypes) when it is available, and otherwise falls
+ back to polling the mtimes of the watched folders.  Either way, a file is only
+ handled once nothing has written to it for <settle> seconds, and a .flm file
+ is only imported once a matching .fits file has landed too (in the same folder
+ or one subfolder down, as yield_all_spectra expects).  Nothing is ever rescanned
+ from the top: only the new files are sent on to add2db.
+"""
+
+import os
+import time
+import errno
+import fnmatch
+import select
+import struct
+import ctypes
+import ctypes.util
+import SNDBLib
+import add2db
+
+SPEC_ROOT = '/media/raid0/Data/spectra/'
+PHOT_ROOT = '/media/raid0/Data/photometry/'
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct( 'iIII' )
+
+class InotifyWatcher( object ):
+    """
+    Watches every folder below each of <roots> with inotify, and reports the
+     paths of files that were created or written to.
+    Folders created later are watched as soon as they show up.
+    """
+    def __init__( self, roots ):
+        self.libc = ctypes.CDLL( ctypes.util.find_library('c'), use_errno=True )
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError( ctypes.get_errno(), 'inotify_init failed' )
+        self.roots = roots
+        self.wds = {}
+        for root in roots:
+            self.add_tree( root )
+
+    def add_tree( self, location ):
+        """
+        Watches location and every folder below it.
+        Returns the paths of the files already in there.
+        """
+        found = []
+        for d, subdirs, fnames in SNDBLib.walk_directories( location ):
+            wd = self.libc.inotify_add_watch( self.fd, d, WATCH_MASK )
+            if wd < 0:
+                print 'Cannot watch %s (errno %d)' %(d, ctypes.get_errno())
+                continue
+            self.wds[wd] = d
+            found.extend( [os.path.join(d, f) for f in fnames] )
+        return found
+
+    def read_events( self, timeout=1.0 ):
+        """
+        Waits up to <timeout> seconds and returns a list of the files that changed.
+        """
+        try:
+            r,_,_ = select.select( [self.fd], [], [], timeout )
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not r:
+            return []
+        buf = os.read( self.fd, 64*1024 )
+        changed = []
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from( buf, i )
+            name = buf[i+EVENT_HEADER.size : i+EVENT_HEADER.size+length].rstrip('\0')
+            i += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # the kernel dropped events; re-list everything we are watching
+                print 'inotify queue overflowed; re-listing the watched folders.'
+                for root in self.roots:
+                    changed.extend( self.add_tree( root ) )
+                continue
+            if (wd not in self.wds) or (not name):
+                continue
+            p = os.path.join( self.wds[wd], name )
+            if mask & IN_ISDIR:
+                # a new folder: watch it, and pick up anything written before the watch was in place
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.extend( self.add_tree( p ) )
+            else:
+                changed.append( p )
+        return changed
+
+    def close( self ):
+        os.close( self.fd )
+
+class PollingWatcher( object ):
+    """
+    Fallback for when inotify is not available.
+    Stats every known folder each poll, and only re-lists those whose mtime changed.
+    New files are re-stat'ed on each poll until they stop changing.
+    """
+    def __init__( self, roots, interval=10.0 ):
+        self.interval = interval
+        self.dirs = {}   # folder: (mtime, set of subfolders, set of files)
+        self.hot = {}    # recently changed file: (size, mtime)
+        for root in roots:
+            self.add_tree( root )
+
+    def add_tree( self, location ):
+        found = []
+        for d, subdirs, fnames in SNDBLib.walk_directories( location ):
+            try:
+                mtime = os.stat( d ).st_mtime
+            except OSError:
+                continue
+            self.dirs[d] = (mtime, set(subdirs), set(fnames))
+            found.extend( [os.path.join(d, f) for f in fnames] )
+        return found
+
+    def read_events( self, timeout=None ):
+        if timeout == None:
+            timeout = self.interval
+        time.sleep( timeout )
+        changed = []
+        for d in self.dirs.keys():
+            mtime, subdirs, fnames = self.dirs[d]
+            try:
+                newmtime = os.stat( d ).st_mtime
+            except OSError:
+                del self.dirs[d]
+                continue
+            if newmtime == mtime:
+                continue
+            try:
+                newsubdirs, newfnames = SNDBLib.list_directory( d )
+            except OSError:
+                continue
+            self.dirs[d] = (newmtime, set(newsubdirs), set(newfnames))
+            for f in set(newfnames) - fnames:
+                changed.append( os.path.join(d, f) )
+            for sd in set(newsubdirs) - subdirs:
+                changed.extend( self.add_tree( os.path.join(d, sd) ) )
+        # anything still being written to shows up as a change in size or mtime
+        for p in changed:
+            self.hot[p] = None
+        for p in self.hot.keys():
+            try:
+                st = os.stat( p )
+            except OSError:
+                del self.hot[p]
+                continue
+            if self.hot[p] != (st.st_size, st.st_mtime):
+                self.hot[p] = (st.st_size, st.st_mtime)
+                changed.append( p )
+            else:
+                # settled down since the last poll
+                del self.hot[p]
+        return list(set(changed))
+
+    def close( self ):
+        pass
+
+def get_watcher( roots, poll_interval=10.0 ):
+    """
+    Returns an InotifyWatcher if this system supports inotify, otherwise a PollingWatcher.
+    """
+    try:
+        return InotifyWatcher( roots )
+    except (OSError, AttributeError), e:
+        print 'inotify not available (%s); polling every %.0f s instead.' %(e, poll_interval)
+        return PollingWatcher( roots, poll_interval )
+
+class IngestQueue( object ):
+    """
+    Collects changed files, waits until each has been quiet for <settle> seconds,
+     and holds on to .flm files until their .fits partner has settled too.
+    """
+    def __init__( self, spec_root, phot_root, settle=5.0 ):
+        self.spec_root = os.path.abspath( spec_root ) if spec_root else None
+        self.phot_root = os.path.abspath( phot_root ) if phot_root else None
+        self.settle = settle
+        self.last_event = {}  # path: time of its last change
+        self.waiting = set()  # settled .flm files without a fits partner yet
+
+    def touch( self, p, now=None ):
+        if now == None:
+            now = time.time()
+        self.last_event[ os.path.abspath(p) ] = now
+
+    def _under( self, p, root ):
+        return (root != None) and p.startswith( root + '/' )
+
+    def find_fits( self, flm ):
+        """
+        Returns the path to the fits partner of <flm> if one has landed and settled, else None.
+        """
+        root, f = os.path.split( flm )
+        subdirs, fnames = SNDBLib.list_directory( root )
+        listings = [ ('', fnmatch.filter(fnames, '*.fits')) ]
+        for sd in subdirs:
+            try:
+                listings.append( (sd, fnmatch.filter( SNDBLib.list_directory( os.path.join(root, sd) )[1], '*.fits' )) )
+            except OSError:
+                continue
+        # don't pair with anything still being written
+        listings = [ (sd, [n for n in names if os.path.join(root, sd, n) not in self.last_event]) for sd,names in listings ]
+        pairs, ambiguous = SNDBLib.pair_spectra( [f], listings )
+        if f in ambiguous:
+            print 'Ambiguous fits partner for %s: %s' %(flm, ', '.join(ambiguous[f]))
+        if pairs[f] == None:
+            return None
+        return os.path.join( root, pairs[f] )
+
+    def ready( self, now=None ):
+        """
+        Returns a list of ('spectrum', (flm, fits)) and ('lightcurve', (datfile,)) items
+         that are ready to be imported.
+        """
+        if now == None:
+            now = time.time()
+        settled = [p for p,t in self.last_event.items() if now - t >= self.settle]
+        for p in settled:
+            del self.last_event[p]
+        out = []
+        recheck = set()
+        for p in settled:
+            if self._under( p, self.spec_root ):
+                if p.endswith( '.flm' ) and ('details' not in p):
+                    self.waiting.add( p )
+                    recheck.add( p )
+                elif p.endswith( '.fits' ):
+                    # this might be the partner some waiting .flm needed
+                    d = os.path.dirname( p )
+                    recheck.update( [flm for flm in self.waiting if os.path.dirname(flm) in [d, os.path.dirname(d)]] )
+            elif self._under( p, self.phot_root ) and p.endswith( '.dat' ):
+                out.append( ('lightcurve', (p,)) )
+        for flm in recheck:
+            try:
+                fit = self.find_fits( flm )
+            except OSError:
+                # the folder went away
+                self.waiting.discard( flm )
+                continue
+            if fit != None:
+                self.waiting.discard( flm )
+                out.append( ('spectrum', (flm, fit)) )
+        return out
+
+def watch( spec_root=SPEC_ROOT, phot_root=PHOT_ROOT, settle=5.0, interactive=True, poll_interval=10.0 ):
+    """
+    Watches <spec_root> and <phot_root> forever (until Ctrl-C), importing new spectra
+     through add2db.import_spectrum_pair and new lightcurves through add2db.handle_lightcurve.
+    Either root can be None to skip it.
+    """
+    roots = [r for r in [spec_root, phot_root] if r]
+    watcher = get_watcher( roots, poll_interval )
+    queue = IngestQueue( spec_root, phot_root, settle )
+    print 'Watching %s for new files.' %(' and '.join(roots))
+    try:
+        while True:
+            for p in watcher.read_events():
+                queue.touch( p )
+            for kind, args in queue.ready():
+                try:
+                    if kind == 'spectrum':
+                        add2db.import_spectrum_pair( args[0], args[1], interactive=interactive )
+                    else:
+                        objname = os.path.basename( args[0] ).split('.')[0]
+                        add2db.handle_lightcurve( args[0], objname )
+                except Exception, e:
+                    # don't let one bad file kill the watcher
+                    print 'Failed to import %s: %s' %(args[0], e)
+    except KeyboardInterrupt:
+        print '\nStopped watching.'
+    finally:
+        watcher.close()
+
+if __name__ == '__main__':
+    watch()